@@ -103,6 +103,10 @@ win_margin_to_become_best_model = 0 #6
 # It also allows the cpu and gpu to work at the same time
 multithreaded = True
 
+# The longest (in microseconds) an evaluation waits for its batch to fill before the partial 
+# batch is evaluated anyway (it can't be None: the last threads of a step would wait forever)
+max_batch_wait = 1000
+
 
 ###################
 # MCTS parameters #
@@ -115,6 +119,33 @@ multithreaded = True
 # maximum exploration steps
 max_steps = 800  # (1 is no MCTS) (AlphGo uses 1600, AlphaZero uses 800)
 
+# Scale the number of steps between min_steps and max_steps by the entropy of the
+# network's policy at the root (confident positions get fewer simulations)
+adaptive_steps = False
+min_steps = 50
+
+# stop the search before max_steps once the chosen action can't change
+# (a solution was found through it, or it can't be overtaken in visit counts)
+early_stopping = False
+
+# how the MCTS chooses the actions at the root:
+# - 'puct': the same as in the rest of the tree (with Dirichlet noise), needs hundreds of steps
+# - 'gumbel': Gumbel top-k sampling + sequential halving, gives good policies with 16-64 steps
+#   (so set max_steps to e.g. 32).  The training policy is then the improved policy.
+#   (early_stopping and dirichlet_const are not used at the root in this mode)
+root_search = 'puct'
+gumbel_considered_actions = 8 # actions sampled at the root for sequential halving (at most 12)
+
+# cache the root statistics of completed searches (by state and model weights), so that a later 
+# search at the same state (common at low distance levels) is warm-started and only runs the 
+# remaining steps
+use_search_result_cache = False
+search_result_cache_size = 10000 # states
+# fraction of the steps which is always searched (even when the cached search has enough visits),
+# so that the cached statistics keep improving instead of being reused as they are
+search_result_cache_fresh_fraction = 0.25
+# (the cache is not used with the shared transposition table, whose root nodes are shared by the games)
+
 # exploration constant (c_puct)
 # note: this is currently scaled by the value of the node because of the decay
 exploration = 1.0
@@ -131,10 +162,55 @@ dirichlet_const = 1/12  # alpha (set to None if not using Dirichlet noise)
 # maximum depth to explore (usually never reached)
 max_depth = 900
 
+# the depth of the simulations can be limited further (to at most max_depth) by:
+# - 'fixed': just max_depth
+# - 'scramble': depth_multiple * the scramble distance of the game
+# - 'value': depth_multiple * the distance to the solved cube estimated from the value at the root
+depth_policy = 'fixed'
+depth_multiple = 3
+
+# once a game's MCTS has created this many nodes, it stops expanding new ones (and uses the value
+# of the parent instead), so that the memory per game is bounded.  None for no limit.
+max_tree_nodes = None
+
+# MCTS-solver: once a node is proven to lead to the solved cube, propagate the proof (and distance)
+# up the tree, and stop searching inside the proven subtree once its distance is known to be the shortest
+mcts_solver = False
+
+# end an MCTS simulation (with the max depth value) as soon as it revisits a state on its path,
+# instead of following the loop until max_depth is reached
+detect_cycles = False
+
+# Endgame table of all states close to the solved cube (made by helpers/close_state_data.py).
+# Known states get their exact value and best actions without calling the neural network.
+# Set to the path of close_state_data.h5 (or its index .npy) to use it, or None.
+endgame_table_path = None # e.g. save_dir + 'close_state_data.h5'
+
+# Number of simulations each MCTS can have waiting on the neural network at once.
+# If > 1, new nodes are expanded asynchronously and the search keeps exploring other paths
+# while the evaluations are batched (only useful if multithreaded).  1 is synchronous.
+max_pending_evaluations = 1
+
 # transposition table settings (usefule if history is 1)
 use_transposition_table = True if prev_state_history == 1 else False
 use_prebuilt_transposition_table = False # this setting is currently not used
 
+# budget for each game's transposition table (None for no limit)
+transposition_table_max_entries = None
+transposition_table_max_bytes = None # estimated, of the index only (evicted nodes stay in the search tree, see max_tree_nodes)
+
+# replacement policy when the budget is exceeded ('clock' or 'depth' for depth-preferred)
+transposition_table_replacement = 'clock'
+
+# share one (thread-safe) transposition table between all the games of a batch (only used if history is 1)
+use_shared_transposition_table = False
+shared_transposition_table_stripes = 16 # number of independently locked parts
+
+# key the MCTS nodes by the canonical form of the state under the 48 color rotations,
+# so that symmetric states share one node (one evaluation and one set of statistics).
+# (only used if history is 1)
+use_symmetry = False
+
 
 
    
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""
+An endgame table for the MCTS.
+
+helpers/close_state_data.py computes every state within distance 6 of the solved
+cube, along with its distance and all the actions which lead to a shortest path.
+This module converts that data (once) into an index sorted by the packed state
+key, which is then memory-mapped, so it costs almost no memory per process and
+a lookup is a binary search.
+
+When a state is in the table, the MCTS doesn't need the neural network: the
+value is exactly gamma ** distance and the prior is spread over the best actions.
+"""
+import numpy as np
+import os
+
+KEY_SIZE = 41 # bytes in np.packbits of a 54 x 6 bit array
+
+index_dtype = np.dtype([('key', 'S{}'.format(KEY_SIZE)),
+                        ('best_actions', np.uint16), # bit mask over the 12 actions
+                        ('distance', np.uint8)])
+
+def pack_key(bit_array):
+    """ The key of a single state (no history) from its 54 x 6 bit array. """
+    return np.packbits(bit_array.reshape(-1)).tobytes()
+
+def build_index(h5_path, index_path):
+    """
+    Convert the hd5 file from helpers/close_state_data.py into a sorted index
+    (a NumPy structured array saved as .npy so it can be memory-mapped).
+    """
+    import h5py
+
+    with h5py.File(h5_path, 'r') as h5f:
+        bits = h5f['bits'][:]
+        best_actions = h5f['best_actions'][:]
+        distances = h5f['distances'][:]
+
+    size = len(bits)
+    index = np.zeros(size, dtype=index_dtype)
+    index['key'] = np.packbits(bits.reshape((size, -1)), axis=1).view('S{}'.format(KEY_SIZE)).reshape(size)
+    index['best_actions'] = (best_actions.astype(np.uint16) << np.arange(12, dtype=np.uint16)).sum(axis=1)
+    index['distance'] = distances
+    index.sort(order='key')
+
+    np.save(index_path, index)
+
+class EndgameOracle():
+    """
+    Exact distances and best actions for all states close to the solved cube.
+    """
+    def __init__(self, index_path):
+        self._index = np.load(index_path, mmap_mode='r')
+        self._keys = self._index['key']
+        self.max_distance = int(self._index['distance'].max()) if len(self._index) else 0
+
+    @staticmethod
+    def load(path):
+        """
+        Load the oracle from either an index file (.npy) or the hd5 file made by
+        helpers/close_state_data.py.  In the latter case, the index is built (once)
+        and saved next to it.
+        """
+        if path.endswith('.npy'):
+            return EndgameOracle(path)
+
+        index_path = os.path.splitext(path)[0] + '_index.npy'
+        if not os.path.exists(index_path):
+            build_index(path, index_path)
+        return EndgameOracle(index_path)
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, bit_array):
+        """
+        Takes the bit array of a single state (no history).
+        Returns (best_actions, distance) where best_actions is a boolean array over the 12 actions,
+        or None if the state is not in the table.
+        """
+        key = np.array(pack_key(bit_array), dtype=self._keys.dtype)
+        i = np.searchsorted(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return None
+
+        entry = self._index[i]
+        best_actions = ((int(entry['best_actions']) >> np.arange(12)) & 1).astype(bool)
+        return best_actions, int(entry['distance'])
+
+    def policy_value(self, bit_array, gamma):
+        """
+        Returns (prior, value, distance) for the state (with the prior uniform over the best actions),
+        or None if the state is not in the table.
+        """
+        entry = self.lookup(bit_array)
+        if entry is None:
+            return None
+
+        best_actions, distance = entry
+        if distance == 0:
+            prior = np.full(12, 1/12)
+        else:
+            prior = best_actions / best_actions.sum()
+        return prior, gamma ** distance, distance
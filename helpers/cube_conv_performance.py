@@ -0,0 +1,58 @@
+"""
+Compares ConvModel2D3D (which gathers all 27 neighbors of each position before
+the convolution, a None x 54 x 27 x filters tensor) with ConvModel2D3DLowMemory
+(which only gathers the neighbors on the cube, one matrix product per kernel
+offset), and NumpyConvModel2D3D (the same network in NumPy).
+
+Both Keras models get the same weights, so their outputs should agree.  For each
+batch size, prints the time per batch of each model and the size of the gathered
+tensor per batch.
+"""
+import numpy as np
+import time
+import os, tempfile
+
+import sys
+sys.path.append('..') # add parent directory to path
+from models import ConvModel2D3D, ConvModel2D3DLowMemory, NumpyConvModel2D3D
+
+filters = 64
+
+if __name__ == '__main__':
+    model = ConvModel2D3D(use_cache=False)
+    model.build()
+
+    low_memory_model = ConvModel2D3DLowMemory(use_cache=False)
+    low_memory_model.build()
+    low_memory_model._model.set_weights(model._model.get_weights()) # the weights are compatible
+
+    numpy_path = os.path.join(tempfile.mkdtemp(), 'model.npz')
+    print("NumPy export max difference:", model.export_numpy(numpy_path))
+    numpy_model = NumpyConvModel2D3D(use_cache=False)
+    numpy_model.load_from_file(numpy_path)
+
+    # just use random data
+    inputs = np.random.choice(2, size=(2**10, 54, 6), p=[48/54, 6/54]).astype(bool)
+
+    policies, values = model._raw_function(inputs[:64])
+    low_memory_policies, low_memory_values = low_memory_model._raw_function(inputs[:64])
+    print("low memory max difference:", max(np.abs(policies - low_memory_policies).max(),
+                                            np.abs(values - low_memory_values).max()))
+
+    for i in range(11):
+        batch_size = 2**i
+        print()
+        print("batch size:", batch_size)
+        print("gathered floats per conv layer (full):      ", batch_size * 54 * 27 * filters)
+        print("gathered floats per conv layer (low memory):", batch_size * 462 * filters)
+
+        my_inputs = inputs.copy().reshape((-1, batch_size, 54, 6))
+
+        for name, m in [("ConvModel2D3D         ", model),
+                        ("ConvModel2D3DLowMemory", low_memory_model),
+                        ("NumpyConvModel2D3D    ", numpy_model)]:
+            m._raw_function(my_inputs[0]) # warm up
+            t1 = time.time()
+            for batch in my_inputs:
+                m._raw_function(batch)
+            print(name, "time per batch:", (time.time() - t1) / len(my_inputs))
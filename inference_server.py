@@ -0,0 +1,403 @@
+"""
+A network inference server in its own process, shared by self-play worker processes.
+
+With threads (BatchGameAgent.run_one_step_with_threading), the tree searches and
+the model's worker thread all run in one process and compete for the GIL.  Here
+the model lives in a server process, and each client (e.g. one per self-play
+process) gets a ring of input and output slots in shared memory.  A client
+writes its input into a free slot and sends the slot number to the server, which
+batches the requests of all the clients together (evaluating a batch once it is
+full or once its oldest request has waited max_batch_wait), writes the outputs
+into the clients' output slots, and sends back the slot numbers.  So the tree
+searches can run on as many cores as there are clients, while the network calls
+stay batched.
+
+    with InferenceServer(ModelLoader('ConvModel', {}, path), clients=4) as server:
+        # pass server.client(i) to the i-th worker process, which uses client.function
+        # (or client.function_async) in place of model.function
+        ...
+        server.swap_model(ModelLoader('ConvModel', {}, new_path)) # hot swap
+
+The new model is built in a background thread of the server, while the old one
+keeps serving, and is swapped in between batches once it is ready.  The clients'
+weights_version changes with each swap (and their caches are cleared).  The
+server and the shared memory are created with 'spawn' (as in parallel_mcts), so
+the clients can be passed to processes started with 'spawn'.
+
+(The self-play in train.py still runs its games as threads of one process, with
+the models' own worker threads.  The server is the building block for moving
+the games to worker processes.)
+"""
+from collections import OrderedDict
+from concurrent.futures import Future
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import queue
+import threading
+import time
+import warnings
+from models import randomize_input, derandomize_policy
+
+def _attach(name, shape, dtype):
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+def _serve(model_factory, request_queue, response_queues, buffer_specs, weights_version,
+           ideal_batch_size, max_batch_wait):
+    model = model_factory()
+    buffers = [(_attach(*input_spec), _attach(*output_spec)) for input_spec, output_spec in buffer_specs]
+    inputs = [input_array for (_, input_array), _ in buffers]
+    outputs = [output_array for _, (_, output_array) in buffers]
+    max_batch_sizes = [1] * len(buffers) # set by each client (e.g. to its number of threads)
+
+    pending = [] # (client id, slot)
+    deadline = None # when the oldest pending request has to be evaluated
+
+    # new models are built in a background thread (one at a time, in order)
+    # and put here, and the thread sends a 'swap_ready' message
+    built_models = queue.Queue()
+    build_lock = threading.Lock()
+
+    def build(factory):
+        with build_lock:
+            try:
+                built_models.put(factory())
+            except Exception as e:
+                built_models.put(e)
+            request_queue.put(('swap_ready', ))
+
+    def is_full():
+        # only the clients with pending requests count (the others may be idle)
+        active_clients = set(client_id for client_id, _ in pending)
+        return len(pending) >= min(ideal_batch_size, sum(max_batch_sizes[client_id] for client_id in active_clients))
+
+    def evaluate():
+        start_time = time.perf_counter()
+        batch = np.array([inputs[client_id][slot] for client_id, slot in pending])
+        policies, values = model.batch_function(batch)
+        evaluation_time = time.perf_counter() - start_time
+        full = is_full()
+
+        finished = {}
+        for (client_id, slot), policy, value in zip(pending, policies, values):
+            outputs[client_id][slot, :12] = policy
+            outputs[client_id][slot, 12] = value
+            finished.setdefault(client_id, []).append(slot)
+        for client_id, slots in finished.items():
+            # the version of the model, and stats of the batch
+            response_queues[client_id].put((slots, weights_version.value, len(pending), full, evaluation_time))
+
+    while True:
+        # wait for a message (but not past the deadline), then take all the waiting messages
+        messages = []
+        try:
+            timeout = None if deadline is None else max(0., deadline - time.perf_counter())
+            messages.append(request_queue.get(timeout=timeout))
+            while len(pending) + len(messages) < ideal_batch_size:
+                messages.append(request_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        for message in messages:
+            command = message[0]
+            if command == 'eval':
+                pending.append(message[1:])
+                if deadline is None:
+                    deadline = time.perf_counter() + max_batch_wait / 1e6
+            elif command == 'max_batch_size':
+                _, client_id, max_batch_size = message
+                max_batch_sizes[client_id] = max(1, max_batch_size)
+            elif command == 'swap':
+                build_thread = threading.Thread(target=build, args=(message[1], ))
+                build_thread.daemon = True
+                build_thread.start()
+            elif command == 'swap_ready':
+                if pending:
+                    evaluate() # with the old model
+                    pending = []
+                    deadline = None
+                new_model = built_models.get()
+                if isinstance(new_model, Exception):
+                    warnings.warn("The model swap failed (the old model is kept): {!r}".format(new_model))
+                    continue
+                model = new_model
+                weights_version.value += 1
+            elif command == 'stop':
+                for (memory, _), (output_memory, _) in buffers:
+                    memory.close()
+                    output_memory.close()
+                return
+
+        if not pending:
+            continue
+
+        if is_full() or (deadline is not None and time.perf_counter() >= deadline):
+            evaluate()
+            pending = []
+            deadline = None
+
+class InferenceClient():
+    """
+    The client side of an InferenceServer (see InferenceServer.client).  It has the interface of a
+    multithreaded model used by the search and game_generator (function, function_async,
+    set_max_batch_size, weights_version, batch_stats and reset_batch_stats), and can be used from
+    any number of threads in one process.  The cache and the rotations are as in BaseModel.
+    (It can't be built, loaded or trained: see InferenceServer.swap_model.)
+    """
+    def __init__(self, client_id, request_queue, response_queue, input_spec, output_spec, weights_version,
+                 history=1, use_cache=True, max_cache_size=10000, rotationally_randomize=False):
+        self.client_id = client_id
+        self.history = history
+        self.use_cache = use_cache
+        self.max_cache_size = max_cache_size
+        self.rotationally_randomize = rotationally_randomize
+        self.multithreaded = True
+
+        self._request_queue = request_queue
+        self._response_queue = response_queue
+        self._input_spec = input_spec
+        self._output_spec = output_spec
+        self._weights_version = weights_version
+        self._attached = False
+        self._attach_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.reset_batch_stats()
+
+    def __getstate__(self):
+        # only the connection to the server is passed to other processes (not the local state)
+        state = dict(self.__dict__)
+        for key in ('_attach_lock', '_stats_lock', '_lock', '_cache', '_cache_version', '_free_slots', '_callbacks',
+                    '_batch_stats', '_enqueue_times', '_input_memory', '_inputs', '_output_memory', '_outputs', '_listener_thread'):
+            state.pop(key, None)
+        state['_attached'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.reset_batch_stats()
+
+    def _attach(self):
+        """ Connects to the shared memory and starts the thread receiving the outputs (on first use) """
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_version = self.weights_version
+        self._input_memory, self._inputs = _attach(*self._input_spec)
+        self._output_memory, self._outputs = _attach(*self._output_spec)
+        self._free_slots = queue.Queue()
+        for slot in range(len(self._inputs)):
+            self._free_slots.put(slot)
+        self._callbacks = {} # slot -> function called with the output and the model's weights version
+        self._enqueue_times = [0.] * len(self._inputs) # time.perf_counter() when each slot was sent
+
+        self._listener_thread = threading.Thread(target=self._listen, args=())
+        self._listener_thread.daemon = True
+        self._listener_thread.start()
+        self._attached = True
+
+    def _listen(self):
+        while True:
+            response = self._response_queue.get()
+            if response is None:
+                return
+            slots, version, batch_size, full, evaluation_time = response
+            latencies = [time.perf_counter() - self._enqueue_times[slot] - evaluation_time for slot in slots]
+            with self._stats_lock:
+                stats = self._batch_stats
+                stats['batches'] += 1
+                stats['inputs'] += len(slots)
+                stats['batch_size_sum'] += batch_size
+                stats['full_batches'] += full
+                stats['queue_latency_sum'] += sum(latencies)
+                stats['queue_latency_max'] = max(stats['queue_latency_max'], max(latencies))
+                stats['evaluation_time_sum'] += evaluation_time
+
+            for slot in slots:
+                output = (self._outputs[slot, :12].copy(), self._outputs[slot, 12])
+                with self._lock:
+                    callback = self._callbacks.pop(slot)
+                self._free_slots.put(slot)
+                callback(output, version)
+
+    def reset_batch_stats(self):
+        with self._stats_lock:
+            self._batch_stats = {'batches': 0, 'inputs': 0, 'batch_size_sum': 0, 'full_batches': 0,
+                                 'queue_latency_sum': 0., 'queue_latency_max': 0., 'evaluation_time_sum': 0.}
+
+    def batch_stats(self):
+        """
+        The same stats as BaseModel.batch_stats, for the server batches with requests of this client
+        (the batch sizes include the other clients' requests; latencies are in microseconds).
+        """
+        with self._stats_lock:
+            stats = dict(self._batch_stats)
+        batches = max(stats['batches'], 1)
+        inputs = max(stats['inputs'], 1)
+        return {'batches': stats['batches'],
+                'inputs': stats['inputs'],
+                'mean_batch_size': stats['batch_size_sum'] / batches,
+                'full_batch_rate': stats['full_batches'] / batches,
+                'mean_queue_latency': 1e6 * stats['queue_latency_sum'] / inputs,
+                'max_queue_latency': 1e6 * stats['queue_latency_max'],
+                'mean_evaluation_time': 1e6 * stats['evaluation_time_sum'] / batches}
+
+    @property
+    def weights_version(self):
+        return self._weights_version.value
+
+    def set_max_batch_size(self, max_batch_size):
+        """ The number of requests this client can have waiting at once (e.g. its number of threads). """
+        self._request_queue.put(('max_batch_size', self.client_id, max_batch_size))
+
+    def _cache_lookup(self, key):
+        with self._lock:
+            if self._cache_version != self.weights_version: # the model was swapped
+                self._cache = OrderedDict()
+                self._cache_version = self.weights_version
+            if key in self._cache:
+                self._cache.move_to_end(key, last=True)
+                return self._cache[key]
+        return None
+
+    def _cache_store(self, key, output, version):
+        with self._lock:
+            if version < self._cache_version:
+                return # computed by a model which was swapped out since
+            if version > self._cache_version:
+                self._cache = OrderedDict()
+                self._cache_version = version
+            self._cache[key] = output
+            if len(self._cache) > self.max_cache_size:
+                self._cache.popitem(last=False)
+
+    def function_async(self, input_array):
+        """
+        Returns a concurrent.futures.Future for the (policy, value) pair.
+        Assume input_array has shape (-1, 54, 6) where -1 represents the history.
+        """
+        if not self._attached:
+            with self._attach_lock:
+                if not self._attached:
+                    self._attach()
+
+        future = Future()
+        rotation_id = None
+        if self.rotationally_randomize:
+            rotation_id = np.random.choice(48)
+            input_array = randomize_input(input_array, rotation_id)
+
+        key = None
+        if self.use_cache:
+            key = input_array.tobytes()
+            cached = self._cache_lookup(key)
+            if cached is not None:
+                policy, value = cached
+                if rotation_id is not None:
+                    policy = derandomize_policy(policy, rotation_id)
+                future.set_result((policy, value))
+                return future
+
+        def finish(output, version):
+            # called by the listener thread
+            policy, value = output
+            if key is not None:
+                self._cache_store(key, output, version)
+            if rotation_id is not None:
+                policy = derandomize_policy(policy, rotation_id)
+            future.set_result((policy, value))
+
+        slot = self._free_slots.get() # waits if all the slots are in use
+        self._inputs[slot] = input_array.reshape(self._inputs.shape[1:])
+        self._enqueue_times[slot] = time.perf_counter()
+        with self._lock:
+            self._callbacks[slot] = finish
+        self._request_queue.put(('eval', self.client_id, slot))
+        return future
+
+    def function(self, input_array):
+        """ The same as function_async, but waits for the (policy, value) pair. """
+        return self.function_async(input_array).result()
+
+    def close(self):
+        if self._attached:
+            self._response_queue.put(None) # stop the listener thread
+            self._listener_thread.join()
+            self._input_memory.close()
+            self._output_memory.close()
+            self._attached = False
+
+class InferenceServer():
+    """
+    Starts a server process which evaluates the model built by model_factory (a picklable
+    callable such as parallel_mcts.ModelLoader) for the given number of clients.
+
+    - slots: the number of requests each client can have waiting at once
+    - ideal_batch_size, max_batch_wait: as for BaseModel (a batch is evaluated once it is full,
+      i.e. has ideal_batch_size requests or the total max_batch_size of the clients with
+      requests in it, or once
+      its oldest request has waited max_batch_wait microseconds)
+    The other keyword arguments are passed to the clients (use_cache, max_cache_size,
+    rotationally_randomize).
+    """
+    def __init__(self, model_factory, clients=1, slots=64, history=1, ideal_batch_size=128, max_batch_wait=1000,
+                 **client_kwargs):
+        assert max_batch_wait is not None, "max_batch_wait is needed to evaluate the partial batches"
+        context = multiprocessing.get_context('spawn')
+        self._request_queue = context.Queue()
+        self._response_queues = [context.Queue() for _ in range(clients)]
+        self._weights_version = context.Value('i', 1)
+
+        self._memories = []
+        buffer_specs = []
+        for _ in range(clients):
+            input_shape = (slots, history, 54, 6)
+            output_shape = (slots, 13) # policy and value
+            input_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(input_shape)))
+            output_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(output_shape)) * 4)
+            self._memories += [input_memory, output_memory]
+            buffer_specs.append(((input_memory.name, input_shape, np.bool_),
+                                 (output_memory.name, output_shape, np.float32)))
+
+        self._clients = [InferenceClient(i, self._request_queue, self._response_queues[i], input_spec, output_spec,
+                                         self._weights_version, history=history, **client_kwargs)
+                         for i, (input_spec, output_spec) in enumerate(buffer_specs)]
+
+        self._process = context.Process(target=_serve, args=(model_factory, self._request_queue, self._response_queues,
+                                                             buffer_specs, self._weights_version,
+                                                             ideal_batch_size, max_batch_wait))
+        self._process.daemon = True
+        self._process.start()
+
+    def client(self, client_id):
+        """ The client with the given id (to pass to a worker process). """
+        return self._clients[client_id]
+
+    @property
+    def weights_version(self):
+        return self._weights_version.value
+
+    def swap_model(self, model_factory):
+        """
+        Replace the model of the server with the one built by model_factory (without waiting).
+        The model is built in the background, and the old one serves the requests until it is ready.
+        """
+        self._request_queue.put(('swap', model_factory))
+
+    def close(self):
+        """ Stop the server process and free the shared memory. """
+        if self._process is None:
+            return
+        self._request_queue.put(('stop', ))
+        self._process.join()
+        self._process = None
+        for memory in self._memories:
+            memory.close()
+            memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
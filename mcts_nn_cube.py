@@ -1,90 +1,214 @@
 import numpy as np
-from batch_cube import BatchCube, position_permutations, color_permutations, opp_action_permutations
+from collections import deque
+import time
+from batch_cube import BatchCube, position_permutations, color_permutations, action_permutations, opp_action_permutations, \
+                       action_array, solved_cube_list
 import warnings
+from search_cache import SearchResult
 
 action_count = 12
 constant_priors = np.array([1/3] * action_count)
 constant_value = .01
 max_depth_value = 0.0
 
+# scale of the Q-values in the Gumbel root search: sigma(q) = (gumbel_c_visit + max visits) * gumbel_c_scale * q
+gumbel_c_visit = 50
+gumbel_c_scale = 0.1 # (the values are first rescaled to [0, 1])
+
+# the color of the squares in the blank history frames (before the start of the game)
+blank_color = 6
+# the bits of the input array for each color (none for the blank color)
+frame_bits = np.eye(7, dtype=bool)[:, :6]
+
+# maps the colors of a cube array under each of the 48 color rotations
+# (the blank color is left unchanged)
+_rotation_color_maps = np.concatenate([np.argsort(color_permutations, axis=1), 
+                                       np.full((48, 1), blank_color)], axis=1).astype(np.uint8)
+
 class State():
     """ 
     This is application specfic.
     This State object should be treated as immutable.
-    We do not store the key, the input array, or a *copy* of the history since 
-    that puts too much load on the memory (and the bottleneck in speed is the 
-    neural network, not the tree search).
+    The history is stored compactly as a (history, 54) uint8 array of colors (newest 
+    first, with 6 for the blank frames before the start), so a child state is one 
+    small copy and the input array and the key are each one NumPy operation.
     """
-    def __init__(self, history=1, random_depth=None, _internal_state=None):
-        if _internal_state is not None:
-            self._internal_state = _internal_state
+    def __init__(self, history=1, random_depth=None, _frames=None):
+        if _frames is not None:
+            self._frames = _frames
         else:
-            blank_history = tuple(None for _ in range(history-1))
             cube = BatchCube(1)
             if random_depth is not None:
                 cube.randomize(random_depth)
-            self._internal_state = (cube, ) + blank_history
+            self._frames = np.full((history, 54), blank_color, dtype=np.uint8)
+            self._frames[0] = cube._cube_array[0]
+
+    @staticmethod
+    def from_cube(cube, history=1):
+        """ The state of a BatchCube of length 1 (with blank history). """
+        frames = np.full((history, 54), blank_color, dtype=np.uint8)
+        frames[0] = cube._cube_array[0]
+        return State(_frames=frames)
 
     # no need for a copy since State is essentially immutable
     #def copy(self):
     #    return State(_internal_state = self.internal_state)
 
     def next(self, action):
-        next_cube = self._internal_state[0].copy()
-        next_cube.step(action)
-        
-        # to save memory, don't copy history 
-        next_internal_state = (next_cube, ) + self._internal_state[:-1]
+        next_frames = np.empty_like(self._frames)
+        next_frames[0] = self._frames[0][action_array[action]]
+        next_frames[1:] = self._frames[:-1]
 
-        return State(_internal_state=next_internal_state)
+        return State(_frames=next_frames)
 
     def input_array(self):
-        bit_arrays = []
-        for c in self._internal_state:
-            if c is None:
-                bit_array = np.zeros((1, 54, 6), dtype=bool)
-            else:
-                bit_array = c.bit_array().reshape((1, 54, 6))
-            bit_arrays.append(bit_array)
-        
-        return np.concatenate(bit_arrays, axis=0)
+        return frame_bits[self._frames]
     
     def input_array_no_history(self):
         """
         Just return the newest state
         """
-        bit_array = self._internal_state[0].bit_array().reshape((1, 54, 6))
-        return bit_array 
+        return frame_bits[self._frames[:1]]
 
     def key(self):
-        return self.input_array().tobytes()
+        # pack two colors per byte to keep the transposition table compact
+        return (self._frames[:, ::2] << 4 | self._frames[:, 1::2]).tobytes()
+
+    def cube_key(self):
+        """ Key of the newest cube only (the same cube reached with different histories has the same key). """
+        return self._frames[0].tobytes()
+
+    def history_length(self):
+        return len(self._frames)
+
+    def canonical(self):
+        """
+        Returns (canonical_state, rotation_id) where canonical_state is the same for all 48 
+        color rotations of this state (the rotation of it with the smallest key), and 
+        rotation_id is a rotation taking this state to it (as in models.randomize_input).
+        The action a in this state corresponds to the action opp_action_permutations[rotation_id][a] 
+        in the canonical state.
+        """
+        rotated = _rotation_color_maps[np.arange(48)[np.newaxis, :, np.newaxis], self._frames[:, position_permutations]]
+        rotated = rotated.transpose((1, 0, 2)) # rotation x frame x position
+
+        keys = [r.tobytes() for r in rotated]
+        rotation_id = min(range(48), key=keys.__getitem__)
+
+        return State(_frames=rotated[rotation_id].copy()), rotation_id
 
     def done(self):
-        cube = self._internal_state[0]
-        return cube.done()[0]
+        return (self._frames[0] == solved_cube_list).all()
 
     def __str__(self):
-        return str(self._internal_state)
+        return str(BatchCube(cube_array=self._frames[:1].astype(int)))
+
+class SearchStats():
+    """
+    Counters and timers for one search (exported by MCTSAgent.stats('search')).
+    Times are in seconds.  The selection time includes the time waiting on the
+    network during selection (which is also counted in nn_wait_time).
+    """
+    def __init__(self):
+        self.simulations = 0
+        self.nodes_created = 0
+        self.transposition_hits = 0
+        self.oracle_hits = 0
+        self.nn_calls = 0
+        self.nn_wait_time = 0.
+        self.max_depth_cutoffs = 0
+        self.cycle_cutoffs = 0 # simulations ended at a state already on their path
+        self.cycle_levels_saved = 0 # max_depth minus the depth of each such cutoff
+        self.expansion_cutoffs = 0 # simulations ended at an unexpanded node because of max_tree_nodes
+        self.selection_time = 0.
+        self.backup_time = 0.
+        self.leaf_depths = [] # made into a histogram when exported
+
+    def as_dict(self):
+        return {'simulations': self.simulations,
+                'nodes_created': self.nodes_created,
+                'transposition_hits': self.transposition_hits,
+                'oracle_hits': self.oracle_hits,
+                'nn_calls': self.nn_calls,
+                'nn_wait_time': self.nn_wait_time,
+                'max_depth_cutoffs': self.max_depth_cutoffs,
+                'cycle_cutoffs': self.cycle_cutoffs,
+                'cycle_levels_saved': self.cycle_levels_saved,
+                'expansion_cutoffs': self.expansion_cutoffs,
+                'selection_time': self.selection_time,
+                'backup_time': self.backup_time,
+                'leaf_depth_histogram': np.bincount(self.leaf_depths, minlength=1)}
 
 class MCTSNode():
     def __init__(self, mcts_agent, state):
+        mcts_agent.nodes_created += 1
+        search_stats = mcts_agent.search_stats
+        search_stats.nodes_created += 1
         self.state = state
         self.terminal = state.done()
+        # length of a proven path from this node to the solved state (None if not proven),
+        # and a lower bound on the distance (the proven distance is exact once they meet)
+        self.proven_distance = 0 if self.terminal else None
+        self.distance_bound = 0 if self.terminal else 1
 
         if not self.terminal:
             self.c_puct = mcts_agent.c_puct
             self.is_leaf_node = True
-            self.prior_probabilities, self.node_value = mcts_agent.model_policy_value(state.input_array())
+            oracle_entry = None
+            if mcts_agent.endgame_oracle is not None:
+                oracle_entry = mcts_agent.endgame_oracle.policy_value(state.input_array_no_history(), mcts_agent.gamma)
+
+            if oracle_entry is not None:
+                # close to the solved cube, the exact value and best actions are known (no network needed)
+                search_stats.oracle_hits += 1
+                self.pending_evaluation = None
+                self.prior_probabilities, self.node_value, self.proven_distance = oracle_entry
+                self.distance_bound = self.proven_distance # (exact)
+            elif mcts_agent.model_policy_value_async is not None:
+                # the priors and value arrive later (see wait_for_evaluation)
+                search_stats.nn_calls += 1
+                self.pending_evaluation = mcts_agent.model_policy_value_async(state.input_array())
+                self.prior_probabilities, self.node_value = None, None
+            else:
+                search_stats.nn_calls += 1
+                self.pending_evaluation = None
+                t = time.perf_counter()
+                self.prior_probabilities, self.node_value = mcts_agent.model_policy_value(state.input_array())
+                search_stats.nn_wait_time += time.perf_counter() - t
             self.total_visit_counts = 0
             self.visit_counts = np.zeros(action_count, dtype=int)
             self.total_action_values = np.zeros(action_count)
             self.mean_action_values = np.zeros(action_count)
             self.children = [None] * action_count
 
-    def upper_confidence_bounds(self):
-        return (self.node_value * self.c_puct * np.sqrt(self.total_visit_counts)) * self.prior_probabilities / (1 + self.visit_counts)
+    def wait_for_evaluation(self, search_stats=None):
+        """ Block until the (asynchronous) network evaluation of this node is available. """
+        # read the future once, since another thread sharing this node may clear it
+        pending = self.pending_evaluation
+        if pending is not None:
+            t = time.perf_counter()
+            self.prior_probabilities, self.node_value = pending.result()
+            self.pending_evaluation = None
+            if search_stats is not None:
+                search_stats.nn_wait_time += time.perf_counter() - t
+
+    def upper_confidence_bounds(self, prior_probabilities=None):
+        if prior_probabilities is None:
+            prior_probabilities = self.prior_probabilities
+        return (self.node_value * self.c_puct * np.sqrt(self.total_visit_counts)) * prior_probabilities / (1 + self.visit_counts)
+
+    def select_action(self, prior_probabilities=None):
+        """ The PUCT action (prior_probabilities can be used to override the node's priors, e.g. with noise) """
+        if prior_probabilities is None:
+            prior_probabilities = self.prior_probabilities
+
+        if self.total_visit_counts:
+            return np.argmax(self.mean_action_values + self.upper_confidence_bounds(prior_probabilities))
+        else:
+            return np.argmax(prior_probabilities) # use prior on first move since mean_action_values and upper_confidence_bounds are all zero
 
-    def child(self, mcts_agent, action):
+    def child(self, mcts_agent, action, create=True):
+        """ The child node for the action (None if it doesn't exist yet and create is False) """
         # return node if already indexed
         child_node = self.children[action]
         if child_node is not None:
@@ -92,68 +216,166 @@ class MCTSNode():
         
         # check transposition table
         next_state = self.state.next(action)
-        key = next_state.key()
-        if mcts_agent.transposition_table is not None and key in mcts_agent.transposition_table:
-            node = mcts_agent.transposition_table[key]
-            self.children[action] = node
-            return node
+        if mcts_agent.use_symmetry:
+            next_state, _ = next_state.canonical()
+        table = mcts_agent.transposition_table
+        if table is not None:
+            key = next_state.key()
+            node = table.get(key)
+            if node is not None:
+                mcts_agent.search_stats.transposition_hits += 1
+                self.children[action] = node
+                return node
+
+        if not create:
+            return None
 
         # create new node
         new_node = MCTSNode(mcts_agent, next_state)
+        if table is not None:
+            # (if the table is shared, another thread may have stored this state in the meantime)
+            new_node = table.setdefault(key, new_node)
         self.children[action] = new_node
-        if mcts_agent.transposition_table is not None:
-            mcts_agent.transposition_table[key] = new_node
         return new_node
 
-    def select_leaf_and_update(self, mcts_agent, max_depth):
-        #print("Entering Node:", self.state, "Depth:", max_depth)
-        # terminal nodes are good
-        if self.terminal:
-            #print("... terminal node, returning 1")
-            # record shortest distance to target
-            depth = mcts_agent.max_depth - max_depth
-            if depth < mcts_agent.shortest_path:
-                mcts_agent.shortest_path = depth
-
-            return 1.
-
-        # we stop at leaf nodes
-        if self.is_leaf_node:
-            self.is_leaf_node = False
-            #print("... leaf node, returning ", self.node_value)
-            return self.node_value
-
-        # reaching max depth is bad
-        # (this should punish loops as well)
-        if not max_depth:
-            #print("... max_depth == 0, returning -1")
-            return max_depth_value
-
-        # otherwise, find new action and follow path
-        if self.total_visit_counts:
-            action = np.argmax(self.mean_action_values + self.upper_confidence_bounds())
-        else:
-            action = np.argmax(self.prior_probabilities) # use prior on first move since mean_action_values and upper_confidence_bounds are all zero
-        
-        # update visit counts before recursing in case we come across the same node again
-        self.total_visit_counts += 1
-        self.visit_counts[action] += 1
-
-        #print("Performing Action:", action)
-        action_value = mcts_agent.gamma * \
-                       self.child(mcts_agent, action) \
-                           .select_leaf_and_update(mcts_agent, max_depth - 1)
-        #print("Returning back to:", max_depth)
+    def select_leaf(self, mcts_agent, max_depth):
+        """
+        Follows the tree down from this node to a leaf, updating the visit counts along the way.
         
-        # recursively update edge values
-        self.total_action_values[action] += action_value
-        self.mean_action_values[action] = self.total_action_values[action] / self.visit_counts[action]
+        Returns (path, value, pending_leaf) where path is the list of (node, action) pairs
+        visited.  If the leaf's evaluation is still pending (see wait_for_evaluation), the value 
+        is None and pending_leaf is the leaf node.  The caller then passes the path and the value 
+        to backup once it is available.
+        """
+        search_stats = mcts_agent.search_stats
+        detect_cycles = mcts_agent.detect_cycles
+        on_path = set()
+        node = self
+        path = []
+        while True:
+            # terminal nodes are good, and so are nodes proven to lead to one at an exact distance
+            # (there is no need to search inside such a subtree, except at the root.  If the 
+            # distance is only an upper bound, a shorter solution may be found below the node.)
+            if node.terminal or (mcts_agent.mcts_solver and path and node.proven_distance is not None 
+                                 and node.proven_distance <= node.distance_bound):
+                # record shortest distance to target
+                depth = len(path) + node.proven_distance
+                if depth < mcts_agent.shortest_path:
+                    mcts_agent.shortest_path = depth
+                    mcts_agent.shortest_path_action = path[0][1] if path else None
+
+                search_stats.leaf_depths.append(len(path))
+                return path, mcts_agent.gamma ** node.proven_distance, None
+
+            # a state already on this path is a loop, which is treated like reaching max depth
+            # (instead of wandering around the loop until max depth is reached)
+            if detect_cycles:
+                cycle_key = id(node) if mcts_agent.cycle_key_by_node else node.state.cube_key()
+                if cycle_key in on_path:
+                    search_stats.cycle_cutoffs += 1
+                    search_stats.cycle_levels_saved += max_depth - len(path)
+                    search_stats.leaf_depths.append(len(path))
+                    return path, max_depth_value, None
+                on_path.add(cycle_key)
+
+            # we stop at leaf nodes
+            if node.is_leaf_node:
+                node.is_leaf_node = False
+                search_stats.leaf_depths.append(len(path))
+                if node.pending_evaluation is not None:
+                    return path, None, node
+                return path, node.node_value, None
+
+            # reaching max depth is bad
+            # (this should punish loops as well)
+            if len(path) == max_depth:
+                search_stats.max_depth_cutoffs += 1
+                search_stats.leaf_depths.append(len(path))
+                return path, max_depth_value, None
+
+            # the node may have been expanded by another simulation which is still waiting on the network
+            if node.pending_evaluation is not None:
+                node.wait_for_evaluation(search_stats)
+
+            # otherwise, find new action and follow path
+            # (the root uses the priors with Dirichlet noise, which are stored in the agent,
+            # unless the root action is chosen by the Gumbel root search)
+            if not path and mcts_agent.forced_root_action is not None:
+                action = mcts_agent.forced_root_action
+            elif node is mcts_agent.initial_node:
+                action = node.select_action(mcts_agent.root_prior_probabilities)
+            else:
+                action = node.select_action()
+            
+            # update visit counts before going down in case we come across the same node again
+            # (this also steers other simulations away from this path while its evaluation is pending)
+            node.total_visit_counts += 1
+            node.visit_counts[action] += 1
+
+            path.append((node, action))
+            if mcts_agent.expansion_allowed():
+                node = node.child(mcts_agent, action)
+            else:
+                child_node = node.child(mcts_agent, action, create=False)
+                if child_node is None:
+                    # out of nodes, so use the value of this node for the child instead of expanding it
+                    search_stats.expansion_cutoffs += 1
+                    search_stats.leaf_depths.append(len(path))
+                    return path, node.node_value, None
+                node = child_node
+
+    @staticmethod
+    def backup(mcts_agent, path, value):
+        """ 
+        Update the edge values along the path with the (decayed) leaf value. 
+        If using the MCTS-solver, also propagate proven distances up the path.
+        """
+        for node, action in reversed(path):
+            if mcts_agent.mcts_solver:
+                # a proven node is worth at least the value of its solution
+                child_node = node.children[action]
+                if child_node is not None and child_node.proven_distance is not None:
+                    value = max(value, mcts_agent.gamma ** child_node.proven_distance)
+            value = mcts_agent.gamma * value
+            node.total_action_values[action] += value
+            node.mean_action_values[action] = node.total_action_values[action] / node.visit_counts[action]
+
+            if mcts_agent.mcts_solver:
+                node.update_proven_distance(action)
+
+        return value
+
+    def update_proven_distance(self, action):
+        """ 
+        If the child is proven at distance d, then this node is proven at distance (at most) d + 1.
+        The distance is also at least 1 + the smallest lower bound of the children (0 for the 
+        children which aren't created yet).
+        """
+        child_node = self.children[action]
+        if child_node is not None and child_node.proven_distance is not None:
+            distance = child_node.proven_distance + 1
+            if self.proven_distance is None or distance < self.proven_distance:
+                self.proven_distance = distance
 
-        # recusively backup leaf value
-        #print("DB: update node", "action:", action, "action value:", action_value)
-        #print(self.status() + "\n")
+        bound = 1 + min(0 if child_node is None else child_node.distance_bound for child_node in self.children)
+        if bound > self.distance_bound:
+            self.distance_bound = bound
 
-        return action_value
+    def select_leaf_and_update(self, mcts_agent, max_depth):
+        """ Run one simulation, waiting on the leaf evaluation if needed. """
+        search_stats = mcts_agent.search_stats
+        t0 = time.perf_counter()
+        path, value, pending_leaf = self.select_leaf(mcts_agent, max_depth)
+        if pending_leaf is not None:
+            pending_leaf.wait_for_evaluation(search_stats)
+            value = pending_leaf.node_value
+        t1 = time.perf_counter()
+
+        value = self.backup(mcts_agent, path, value)
+        search_stats.selection_time += t1 - t0
+        search_stats.backup_time += time.perf_counter() - t1
+        search_stats.simulations += 1
+        return value
 
     def action_visit_counts(self):
         """ Returns action visit counts. """
@@ -194,36 +416,387 @@ class MCTSNode():
 
 class MCTSAgent():
 
-    def __init__(self, model_policy_value, initial_state, max_depth, transposition_table={}, c_puct=1.0, gamma=.95, use_dirichlet=True, dirichlet_const=1/12):
+    def __init__(self, model_policy_value, initial_state, max_depth, transposition_table={}, c_puct=1.0, gamma=.95, use_dirichlet=True, dirichlet_const=1/12,
+                 model_policy_value_async=None, max_pending_evaluations=1, early_stopping=False, mcts_solver=False,
+                 endgame_oracle=None, detect_cycles=False, use_symmetry=False, root_search='puct', 
+                 gumbel_considered_actions=8, initial_node=None, depth_policy='fixed', depth_multiple=3, 
+                 scramble_distance=None, max_tree_nodes=None):
         self.model_policy_value = model_policy_value
+        # If given, this returns a future for the (policy, value) pair, and new nodes are 
+        # created with their evaluation pending.  Then up to max_pending_evaluations 
+        # simulations are kept in flight at once during the search.
+        self.model_policy_value_async = model_policy_value_async
+        self.max_pending_evaluations = max_pending_evaluations
         self.max_depth = max_depth
+        # The depth of the simulations can be limited further by a depth policy:
+        # - 'fixed': max_depth
+        # - 'scramble': depth_multiple times the scramble distance (scramble_distance)
+        # - 'value': depth_multiple times the distance estimated from the root's value
+        assert depth_policy in ('fixed', 'scramble', 'value'), "depth_policy must be 'fixed', 'scramble' or 'value'"
+        assert depth_policy != 'scramble' or scramble_distance is not None, "the 'scramble' depth policy needs the scramble distance"
+        self.depth_policy = depth_policy
+        self.depth_multiple = depth_multiple
+        self.scramble_distance = scramble_distance
+        self.search_max_depth = max_depth # for the current search
+        # Once this many nodes are created (over the life of the agent), the search stops expanding 
+        # new nodes, so that the memory used is bounded (None for no limit)
+        self.max_tree_nodes = max_tree_nodes
         self.total_steps = 0
+        self.nodes_created = 0
+        self.search_stats = SearchStats() # for the current (or last) search
+        # stop the search early once the decision at the root is settled (see search_is_settled)
+        self.early_stopping = early_stopping
+        self.simulations_saved = 0 # by early stopping in the last search
+        self.total_simulations_saved = 0
+        self.simulations_reused = 0 # from a cached search (see warm_start) at the current root
+        # propagate proven solutions (and their distances) up the tree and don't search inside subtrees
+        # whose proven distance is exact
+        self.mcts_solver = mcts_solver
+        # an EndgameOracle (see endgame_oracle.py) consulted before the network, or None
+        self.endgame_oracle = endgame_oracle
         self.transposition_table = transposition_table
+        # end a simulation as soon as it revisits a state on its own path
+        self.detect_cycles = detect_cycles
+        # with a transposition table (and no history) each state has exactly one node,
+        # so the path can be checked by node instead of by (the more costly) cube key
+        # (unless the table evicts entries, since an evicted state can get a second node)
+        self.cycle_key_by_node = transposition_table is not None and initial_state.history_length() == 1 and \
+                                 not (hasattr(transposition_table, 'is_bounded') and transposition_table.is_bounded())
         self.c_puct = c_puct  # exploration constant
         self.gamma = gamma  # decay constant
         self.dirichlet_const = dirichlet_const # alpha (None if no Dirichlet noise)
 
-        self.initial_node = MCTSNode(self, initial_state)
+        # How the root actions are chosen:
+        # - 'puct': as in the rest of the tree (with Dirichlet noise)
+        # - 'gumbel': Gumbel top-k sampling of gumbel_considered_actions actions, then sequential 
+        #   halving between them (see _gumbel_root_actions).  This gives good policies with 
+        #   few simulations.  The policy is then the improved policy from the completed Q-values.
+        assert root_search in ('puct', 'gumbel'), "root_search must be 'puct' or 'gumbel'"
+        self.root_search = root_search
+        self.gumbel_considered_actions = gumbel_considered_actions
+        self.forced_root_action = None # the root action for the next simulation (if not None)
+        self.gumbel_noise = None # sampled for each search
+        self.gumbel_candidates = None # the root actions still considered by sequential halving
+
+        # If set, the nodes hold the canonical form of their states (see State.canonical), so all
+        # 48 color rotations of a state share one node (evaluation and statistics).  The tree 
+        # is then in the canonical frame, and the root statistics and actions are mapped to the
+        # frame of the actual root state (root_state) by the methods below.
+        self.use_symmetry = use_symmetry
+        self.root_state = initial_state
+        self.root_rotation = None # the rotation from root_state to the state of initial_node
+
+        # (an existing root node can be given, e.g. from tree_snapshot.load_tree, to not call the network)
+        node_state = self._root_node_state()
+        self.initial_node = MCTSNode(self, node_state) if initial_node is None else initial_node
+        self._set_root_priors()
+
+        self.shortest_path = self.max_depth + 1
+        self.shortest_path_action = None # the root action leading to the shortest path
+
+    def _root_node_state(self):
+        """ The state for the root node (the canonical form if use_symmetry).  Also updates root_rotation. """
+        if not self.use_symmetry:
+            return self.root_state
+
+        node_state, self.root_rotation = self.root_state.canonical()
+        return node_state
+
+    def _to_root_frame(self, action_array):
+        """ Maps an array over the actions of the root node to the actions of the actual root state. """
+        if self.root_rotation is None or action_array is None:
+            return action_array
+        return action_array[opp_action_permutations[self.root_rotation]]
+
+    def _to_node_action(self, action):
+        """ Maps an action of the actual root state to the action of the root node. """
+        if self.root_rotation is None:
+            return action
+        return opp_action_permutations[self.root_rotation][action]
+
+    def _to_root_action(self, node_action):
+        """ Maps an action of the root node to the action of the actual root state. """
+        if self.root_rotation is None:
+            return node_action
+        return action_permutations[self.root_rotation][node_action]
+
+    def _set_root_priors(self):
+        """
+        Mix Dirichlet noise into the priors of the root.  The node keeps its raw priors
+        (and value) from when it was evaluated so the network isn't called again.
+        """
+        if self.initial_node.terminal:
+            self.root_prior_probabilities = None
+            return
+
+        self.initial_node.wait_for_evaluation()
         if self.dirichlet_const is None:
-            self.initial_node.prior_probabilities = self.model_policy_value(self.initial_node.state.input_array())[0]
+            self.root_prior_probabilities = self.initial_node.prior_probabilities
         else:    
-            self.initial_node.prior_probabilities = \
-                .75 * self.model_policy_value(self.initial_node.state.input_array())[0] +\
+            self.root_prior_probabilities = \
+                .75 * self.initial_node.prior_probabilities +\
                 .25 * np.random.dirichlet([self.dirichlet_const]*action_count, 1)[0]
 
-        self.shortest_path = self.max_depth + 1
+    def search(self, steps=None, deadline=None, max_nodes=None):
+        """
+        Run simulations until one of the given budgets runs out:
+        - steps: the number of simulations
+        - deadline: the time (as given by time.time()) to stop by
+        - max_nodes: the number of new nodes this search may create (a memory budget)
+        At least one simulation is run (unless steps = 0).  If early_stopping is set, the
+        search also stops once the decision at the root is settled.
+
+        If model_policy_value_async is set (and max_pending_evaluations > 1), new paths are 
+        selected while the network evaluates the leaves of earlier simulations.  The pending 
+        simulations are backed up (in order) once their evaluations land.
+        """
+        assert steps is not None or deadline is not None or max_nodes is not None, "no search budget given"
 
-    def search(self, steps):
         self.initial_node.is_leaf_node = False # so that at least exactly one move if steps = 1
-        for s in range(steps):
-            self.initial_node.select_leaf_and_update(self, self.max_depth) # explore new leaf node
+        self.simulations_saved = 0
+        self.search_stats = SearchStats()
+        self.search_max_depth = self.search_depth()
+        node_limit = None if max_nodes is None else self.nodes_created + max_nodes
+        pipelined = self.model_policy_value_async is not None and self.max_pending_evaluations > 1
+        in_flight = deque() # (path, pending leaf node)
+
+        gumbel_schedule = None
+        if self.root_search == 'gumbel' and not self.initial_node.terminal:
+            assert steps is not None, "the Gumbel root search needs the number of steps"
+            gumbel_schedule = self._gumbel_root_actions(steps)
+
+        s = 0
+        while steps is None or s < steps:
+            if s and ((deadline is not None and time.time() >= deadline) or
+                      (node_limit is not None and self.nodes_created >= node_limit)):
+                break
+
+            if gumbel_schedule is not None:
+                self.forced_root_action = next(gumbel_schedule)
+
+            if pipelined:
+                self._pipelined_simulation(in_flight)
+            else:
+                self.initial_node.select_leaf_and_update(self, self.search_max_depth) # explore new leaf node
+            s += 1
             self.total_steps += 1
 
+            remaining_steps = None if steps is None else steps - s
+            if self.early_stopping and gumbel_schedule is None and self.search_is_settled(remaining_steps):
+                if remaining_steps is not None:
+                    self._record_saved_simulations(remaining_steps)
+                break
+
+        while in_flight:
+            self._backup_oldest_pending(in_flight)
+        self.forced_root_action = None
+
+    def _gumbel_root_actions(self, steps):
+        """
+        Generates the root action of each simulation for the Gumbel root search (as in
+        "Policy improvement by planning with Gumbel", Danihelka et al.): 
+        Sample the gumbel_considered_actions actions with the top Gumbel noise + logits, then 
+        split the steps into log2(gumbel_considered_actions) phases.  In each phase the remaining 
+        actions are visited equally, and then the better half of them (by noise + logits + sigma(q)) 
+        is kept.
+        """
+        logits = self._root_logits()
+        self.gumbel_noise = np.random.gumbel(size=action_count)
+
+        considered = min(self.gumbel_considered_actions, action_count)
+        candidates = np.argsort(-(self.gumbel_noise + logits))[:considered]
+        self.gumbel_candidates = candidates
+        phases = max(1, int(np.ceil(np.log2(considered))))
+
+        for _ in range(phases):
+            visits_per_action = max(1, steps // (phases * len(candidates)))
+            for _ in range(visits_per_action):
+                for action in candidates:
+                    yield action
+
+            if len(candidates) > 1:
+                scores = self._gumbel_scores()[candidates]
+                candidates = candidates[np.argsort(-scores)[:len(candidates) // 2]]
+                self.gumbel_candidates = candidates
+
+        while True:
+            yield candidates[0]
+
+    def _root_logits(self):
+        return np.log(np.maximum(self.initial_node.prior_probabilities, 1e-12))
+
+    def _completed_q_values(self):
+        """ 
+        The mean action values of the root, where the unvisited actions get the value 
+        estimate v_mix (the network value mixed with the prior-weighted values of the visited actions).
+        """
+        node = self.initial_node
+        visited = node.visit_counts > 0
+        total_visits = node.visit_counts.sum()
+        if not visited.any():
+            return np.full(action_count, node.node_value)
+
+        prior = node.prior_probabilities
+        visited_value = (prior[visited] * node.mean_action_values[visited]).sum() / max(prior[visited].sum(), 1e-12)
+        mixed_value = (node.node_value + total_visits * visited_value) / (1 + total_visits)
+        return np.where(visited, node.mean_action_values, mixed_value)
+
+    def _sigma(self, q_values):
+        # rescale the values to [0, 1] first (as in the paper)
+        q_min, q_max = q_values.min(), q_values.max()
+        if q_max > q_min:
+            q_values = (q_values - q_min) / (q_max - q_min)
+        return (gumbel_c_visit + self.initial_node.visit_counts.max()) * gumbel_c_scale * q_values
+
+    def _gumbel_scores(self):
+        return self.gumbel_noise + self._root_logits() + self._sigma(self._completed_q_values())
+
+    def improved_policy(self):
+        """ The policy softmax(logits + sigma(completed q-values)) of the Gumbel root search (in the node's frame). """
+        scores = self._root_logits() + self._sigma(self._completed_q_values())
+        exponentiated = np.exp(scores - scores.max())
+        return exponentiated / exponentiated.sum()
+
+    def search_depth(self):
+        """ The maximum depth of the simulations from the current root (see depth_policy). """
+        if self.depth_policy == 'fixed' or self.initial_node.terminal:
+            return self.max_depth
+
+        if self.depth_policy == 'scramble':
+            depth = self.depth_multiple * self.scramble_distance
+        else:
+            self.initial_node.wait_for_evaluation()
+            value = max(self.initial_node.node_value, 1e-6)
+            depth = self.depth_multiple * np.log(value) / np.log(self.gamma)
+        return int(min(self.max_depth, max(1, np.ceil(depth))))
+
+    def expansion_allowed(self):
+        return self.max_tree_nodes is None or self.nodes_created < self.max_tree_nodes
+
+    def _pipelined_simulation(self, in_flight):
+        t = time.perf_counter()
+        path, value, pending_leaf = self.initial_node.select_leaf(self, self.search_max_depth)
+        self.search_stats.selection_time += time.perf_counter() - t
+
+        if pending_leaf is None:
+            self._timed_backup(path, value)
+        else:
+            in_flight.append((path, pending_leaf))
+
+        # backup any finished simulations, and block on the oldest if too many are pending
+        while in_flight and (len(in_flight) >= self.max_pending_evaluations or 
+                             self._evaluation_done(in_flight[0][1])):
+            self._backup_oldest_pending(in_flight)
+
+    @staticmethod
+    def _evaluation_done(node):
+        pending = node.pending_evaluation # (read once, see MCTSNode.wait_for_evaluation)
+        return pending is None or pending.done()
+
+    def _backup_oldest_pending(self, in_flight):
+        path, leaf = in_flight.popleft()
+        leaf.wait_for_evaluation(self.search_stats)
+        self._timed_backup(path, leaf.node_value)
+
+    def _timed_backup(self, path, value):
+        t = time.perf_counter()
+        MCTSNode.backup(self, path, value)
+        self.search_stats.backup_time += time.perf_counter() - t
+        self.search_stats.simulations += 1
+
+    def adaptive_steps(self, min_steps, max_steps):
+        """
+        A number of simulations between min_steps and max_steps, scaled by the entropy
+        of the root's prior.  A confident network (low entropy) gets fewer simulations.
+        """
+        if self.initial_node.terminal:
+            return min_steps
+
+        prior = self.initial_node.prior_probabilities
+        nonzero = prior[prior > 0]
+        entropy = -np.sum(nonzero * np.log(nonzero)) / np.log(action_count) # between 0 and 1
+        return int(round(min_steps + (max_steps - min_steps) * entropy))
+
+    def search_is_settled(self, remaining_steps):
+        """
+        Whether more simulations can't change the action chosen at the root, either because:
+        - a solution was found through the most visited action, or
+        - the most visited action can't be overtaken in the remaining simulations
+          (only checked if the number of remaining simulations is known).
+        """
+        if self.initial_node.terminal:
+            return True
+
+        visit_counts = self.initial_node.visit_counts
+        best_action = np.argmax(visit_counts)
+
+        if self.shortest_path <= self.max_depth and self.shortest_path_action == best_action:
+            return True
+
+        if remaining_steps is None:
+            return False
+
+        second_most, most = np.partition(visit_counts, action_count - 2)[-2:]
+        return most - second_most > remaining_steps
+
+    def _record_saved_simulations(self, saved):
+        self.simulations_saved = saved
+        self.total_simulations_saved += saved
+
+    def search_result(self):
+        """ The root statistics of the search (for a SearchResultCache), or None if the root wasn't searched. """
+        node = self.initial_node
+        if node.terminal or node.is_leaf_node:
+            return None
+        return SearchResult(visit_counts=node.visit_counts.copy(),
+                            total_action_values=node.total_action_values.copy(),
+                            shortest_path=self.shortest_path,
+                            shortest_path_action=self.shortest_path_action)
+
+    def warm_start(self, result):
+        """
+        Load the root statistics of an earlier search at the same state (from search_result), 
+        unless the root already has more visits (e.g. from the previous move's search).
+        Returns the number of simulations reused.
+        """
+        node = self.initial_node
+        visits = result.visit_counts.sum()
+        if node.terminal or visits <= node.total_visit_counts:
+            return 0
+
+        node.wait_for_evaluation()
+        node.is_leaf_node = False
+        node.visit_counts = result.visit_counts.copy()
+        node.total_visit_counts = visits
+        node.total_action_values = result.total_action_values.copy()
+        node.mean_action_values = np.where(node.visit_counts > 0, 
+                                           node.total_action_values / np.maximum(node.visit_counts, 1), 0.)
+        if result.shortest_path < self.shortest_path:
+            self.shortest_path = result.shortest_path
+            self.shortest_path_action = result.shortest_path_action
+
+        self.simulations_reused = visits
+        return visits
+
     def action_visit_counts(self):
-        return self.initial_node.action_visit_counts()
+        return self._to_root_frame(self.initial_node.action_visit_counts())
     
     def action_probabilities(self, inv_temp):
-        return self.initial_node.action_probabilities(inv_temp)
+        """ The visit count distribution (or the improved policy if using the Gumbel root search, ignoring inv_temp) """
+        if self.root_search == 'gumbel' and self.gumbel_candidates is not None and \
+           not (self.initial_node.terminal or self.initial_node.is_leaf_node):
+            return self._to_root_frame(self.improved_policy())
+        return self._to_root_frame(self.initial_node.action_probabilities(inv_temp))
+
+    def best_action(self):
+        """ 
+        The action to play after a search: the most visited action, or the winner of 
+        sequential halving if using the Gumbel root search.
+        """
+        if self.root_search == 'gumbel' and self.gumbel_candidates is not None:
+            scores = self._gumbel_scores()[self.gumbel_candidates]
+            return self._to_root_action(self.gumbel_candidates[np.argmax(scores)])
+        return np.argmax(self.action_visit_counts())
 
     def initial_node_status(self):
         return self.initial_node.status()
@@ -234,8 +807,7 @@ class MCTSAgent():
     def advance_to_best_child(self):
         """ Advance to the best child node """
         
-        best_action = np.argmax(self.action_visit_counts())
-        self.advance_to_action(best_action)
+        self.advance_to_action(self.best_action())
 
     def advance_to_action(self, action):
         """ Advance to a child node via the given action """
@@ -243,31 +815,56 @@ class MCTSAgent():
         # TOFIX: I should (maybe?) find a way to delete the nodes not below this one, 
         # including from the tranposition table
         
-        self.initial_node = self.initial_node.child(self, action) 
-        if self.dirichlet_const is None:
-            self.initial_node.prior_probabilities = self.model_policy_value(self.initial_node.state.input_array())[0]
-        else:    
-            self.initial_node.prior_probabilities = \
-                .75 * self.model_policy_value(self.initial_node.state.input_array())[0] +\
-                .25 * np.random.dirichlet([self.dirichlet_const]*action_count, 1)[0]
+        node_action = self._to_node_action(action)
+        self.root_state = self.root_state.next(action)
+        self._root_node_state() # (to update root_rotation)
+        self.initial_node = self.initial_node.child(self, node_action) 
+        self._set_root_priors()
         
         self.shortest_path = self.max_depth + 1
+        self.shortest_path_action = None
+        if self.mcts_solver:
+            self._shortest_proven_path()
+        self.gumbel_noise = None
+        self.gumbel_candidates = None
+        self.simulations_reused = 0
+
+    def _shortest_proven_path(self):
+        """ Start the shortest path from the proven children of the (new) root, if any """
+        node = self.initial_node
+        if node.terminal:
+            return
+        for action, child_node in enumerate(node.children):
+            if child_node is not None and child_node.proven_distance is not None \
+               and child_node.proven_distance + 1 < self.shortest_path:
+                self.shortest_path = child_node.proven_distance + 1
+                self.shortest_path_action = action
 
     def stats(self, key):
         """ Proviods various stats on the MCTS """
         
         if key == 'shortest_path':
             return self.shortest_path if self.shortest_path <= self.max_depth else -1
+        elif key == 'shortest_path_action':
+            return self._to_root_action(self.shortest_path_action) if self.shortest_path_action is not None else -1
         elif key == 'prior':
-            return self.model_policy_value(self.initial_node.state.input_array())[0]
+            return self._to_root_frame(self.initial_node.prior_probabilities)
         elif key == 'prior_dirichlet':
-            return self.initial_node.prior_probabilities
+            return self._to_root_frame(self.root_prior_probabilities)
         elif key == 'value':
-            return self.model_policy_value(self.initial_node.state.input_array())[1]
+            return self.initial_node.node_value
+        elif key == 'proven_distance':
+            return self.initial_node.proven_distance if self.initial_node.proven_distance is not None else -1
+        elif key == 'simulations_saved':
+            return self.simulations_saved
+        elif key == 'simulations_reused':
+            return self.simulations_reused
+        elif key == 'search':
+            return self.search_stats.as_dict()
         elif key == 'visit_counts':
-            return self.initial_node.visit_counts
+            return self._to_root_frame(self.initial_node.visit_counts)
         elif key == 'total_action_values':
-            return self.initial_node.total_action_values
+            return self._to_root_frame(self.initial_node.total_action_values)
         else:
             warnings.warn("'{}' argument not implemented for stats".format(key), stacklevel=2)
             return None
@@ -312,7 +909,7 @@ def main():
             else:
                 mcts.search(steps = 10000)
                 prior, _ = model_policy_value(mcts.initial_node.state.input_array())
-                prior2 = mcts.initial_node.prior_probabilities
+                prior2 = mcts.stats('prior_dirichlet')
                 probs = mcts.action_probabilities(inv_temp = 1)
                 q = mcts.initial_node.mean_action_values
                 model.fit(state.input_array(), probs.reshape((1,12)), epochs=1, verbose=0)
@@ -7,7 +7,8 @@ import numpy as np
 import time
 from batch_cube import BatchCube, position_permutations, color_permutations, action_permutations, opp_action_permutations
 import warnings
-import threading, queue
+import threading
+from concurrent.futures import Future
 
 
 def randomize_input(input_array, rotation_id):
@@ -50,12 +51,116 @@ def augment_data(inputs, policies, values):
 
     return inputs, policies, values
 
-class Task:
-    def __init__(self):
-        self.lock = threading.Condition()
-        self.input = None
-        self.output = None
-        self.kill_thread = False
+class BatchBuffer:
+    """
+    A preallocated batch for the worker thread.  The callers write their inputs 
+    directly into a slot of the input array, and read their outputs back from 
+    the same slot of the output arrays once the batch is done.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.inputs = None # allocated on the first write (when the input shape is known)
+        self.policies = np.zeros((size, 12), dtype=np.float32)
+        self.values = np.zeros((size, 1), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        self.count = 0 # slots taken
+        self.done = False # outputs written
+        self.pending_reads = 0 # waiting callers which have not yet read their outputs
+        self.callbacks = [] # (slot, function called with the output) for the asynchronous calls
+        self.first_enqueue_time = None # time.perf_counter() when the first slot was taken
+        self.enqueue_time_sum = 0. # (for the latency stats)
+
+    def write(self, input_array):
+        """ Takes the next slot for the input (of shape (1, ) + input shape), and returns it """
+        if self.inputs is None:
+            self.inputs = np.zeros((self.size, ) + input_array.shape[1:], dtype=input_array.dtype)
+        slot = self.count
+        self.inputs[slot] = input_array[0]
+        self.count += 1
+
+        enqueue_time = time.perf_counter()
+        if slot == 0:
+            self.first_enqueue_time = enqueue_time
+        self.enqueue_time_sum += enqueue_time
+        return slot
+
+    def output(self, slot):
+        return [self.policies[slot:slot+1].copy(), self.values[slot:slot+1].copy()]
+
+class InferenceService:
+    """
+    One worker thread evaluating the batches of several models (e.g. the best and the 
+    checkpoint model during evaluation), instead of a worker thread per model.  Each 
+    model is batched independently (as with its own worker thread), and the worker 
+    takes the ready batches of the models in turn, so that while one model's batch 
+    is evaluated, the others fill up.
+
+    Add the (multithreaded) models before they are built.
+    """
+    def __init__(self, models=()):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._models = []
+        self._worker_thread = None
+        self._stop_worker = False
+        for model in models:
+            self.add_model(model)
+
+    def add_model(self, model):
+        # the models share the lock and the worker condition of the service
+        with self._lock:
+            model._service = self
+            model._batch_lock = self._lock
+            model._worker_condition = self._condition
+            model._caller_condition = threading.Condition(self._lock)
+            self._models.append(model)
+
+    def start(self):
+        """ Starts the worker thread (if not running) """
+        with self._lock:
+            if self._worker_thread is not None:
+                return
+            self._stop_worker = False
+            self._worker_thread = threading.Thread(target=self._worker, args=())
+            self._worker_thread.daemon = True
+            self._worker_thread.start()
+
+    def stop(self):
+        with self._lock:
+            if self._worker_thread is None:
+                return
+            self._stop_worker = True
+            self._condition.notify()
+            worker_thread = self._worker_thread
+        worker_thread.join()
+        self._worker_thread = None
+
+    def _worker(self):
+        next_model = 0 # round robin over the models
+        while True:
+            with self._lock:
+                while True:
+                    if self._stop_worker:
+                        return
+                    timeouts = []
+                    for i in range(len(self._models)):
+                        model = self._models[(next_model + i) % len(self._models)]
+                        if model._filling_buffer is None: # not started
+                            continue
+                        batch, full_or_timeout = model._next_batch()
+                        if batch is not None:
+                            break
+                        if full_or_timeout is not None:
+                            timeouts.append(full_or_timeout)
+                    else:
+                        self._condition.wait(min(timeouts) if timeouts else None)
+                        continue
+                    break
+                next_model = (next_model + i + 1) % len(self._models)
+
+            model._evaluate_batch(batch, full_or_timeout)
 
 class BaseModel(): 
     """
@@ -69,6 +174,7 @@ class BaseModel():
         self._time_sum = 0 # used for measuring computation timing
         self._cache = None
         self._get_output = None
+        self.weights_version = 0 # incremented whenever the network changes (e.g. to key caches of search results)
         self.use_cache = use_cache
         self.rotationally_randomize = rotationally_randomize
         self.max_cache_size = max_cache_size
@@ -77,25 +183,41 @@ class BaseModel():
         # multithreading, batch evaluation support
         self.multithreaded = False
         self.ideal_batch_size = 128
+        # A batch is evaluated once it is full (see set_max_batch_size) or once its oldest 
+        # input has waited this long (in microseconds).  The callers don't lower the max batch 
+        # size as they finish, so there has to be a deadline for the last batches.
+        self.max_batch_wait = 1000
         self._lock = threading.RLock()
         self._max_batch_size = 1
-        self._queue = queue.Queue()
         self._worker_thread = None
+        self._stop_worker = False
+
+        # Two preallocated batches: the callers fill one while the worker evaluates the other.
+        # Both conditions share one lock.  The worker waits on the first (for a full batch, 
+        # the deadline, or a free buffer) and the callers wait on the second (for outputs or a free slot).
+        self._batch_lock = threading.Lock()
+        self._worker_condition = threading.Condition(self._batch_lock)
+        self._caller_condition = threading.Condition(self._batch_lock)
+        self._filling_buffer = None
+        self._spare_buffer = None
+        self._service = None # set if the batches are evaluated by an InferenceService (instead of a worker thread)
+        self.reset_batch_stats()
 
         # to reimplement for each model.  Leave off the first dimension.
         self.input_shape = (54, self.history * 6)
 
     def set_max_batch_size(self, max_batch_size):
-        with self._lock:
-            self._max_batch_size = max_batch_size
-        
-        # put a dummy task on the queue to make sure the worker notices the update to the max_batch_size
-        dummy_task = Task()
-        with dummy_task.lock:
-            self._queue.put(dummy_task)
+        """ 
+        The batch is evaluated as soon as it has this many inputs (or ideal_batch_size if smaller), 
+        e.g. set it to the number of threads calling the model.  Partial batches are evaluated 
+        after max_batch_wait.
+        """
+        with self._batch_lock:
+            self._max_batch_size = max(1, max_batch_size)
+            self._worker_condition.notify() # so the worker notices the update to the max_batch_size
 
     def get_max_batch_size(self):
-        with self._lock:
+        with self._batch_lock:
             return self._max_batch_size
 
     def _build(self, model):
@@ -129,6 +251,7 @@ class BaseModel():
         """
         from keras import backend as K
         self._cache = OrderedDict()
+        self.weights_version += 1
 
         # run model once to make sure it loads correctly (needed for K.function to work on new models)
         trivial_input = np.zeros((1, ) + self.input_shape)
@@ -149,82 +272,176 @@ class BaseModel():
         self._time_sum = time.time() - t1 
         return out
 
-    def _raw_function_worker(self):
-        import numpy as np
-        task_list = []
+    def _next_batch(self):
+        """
+        Called by the worker with the batch lock held.  If the batch is full or its oldest input 
+        has waited max_batch_wait (and the callers of the previous batch have read their outputs), 
+        swaps the buffers and returns (batch, full).  Otherwise returns (None, the time to wait 
+        in seconds, or None to wait for a notification).
+        """
+        count = self._filling_buffer.count
+        full = count > 0 and count >= min(self._filling_buffer.size, self._max_batch_size)
+        if not full:
+            if not count:
+                return None, None
+            timeout = self._filling_buffer.first_enqueue_time + self.max_batch_wait / 1e6 - time.perf_counter()
+            if timeout > 0:
+                return None, timeout
+
+        if self._spare_buffer.pending_reads:
+            return None, None # notified when the last of them is read
+
+        batch = self._filling_buffer
+        self._spare_buffer.reset()
+        self._filling_buffer, self._spare_buffer = self._spare_buffer, batch
+        if batch.count == batch.size:
+            self._caller_condition.notify_all() # callers may be waiting for a free slot
+        return batch, batch.count >= min(batch.size, self._max_batch_size)
 
+    def _raw_function_worker(self):
         while True:
-            # retrieve items from the queue
-            task = self._queue.get()
-            with task.lock:
-                if task.kill_thread:
-                    task.lock.notify()
-                    return
-                
-                if task.input is not None: #ignore other tasks as dummy tasks
-                    task_list.append(task)
-
-            if task_list and len(task_list) >= min(self.ideal_batch_size, self.get_max_batch_size()):
-                array = np.array([task.input.squeeze(axis=0) for task in task_list])
-                policies, values = self._get_output([array, 0])
-
-                for p, v, task in zip(policies, values, task_list):
-                    with task.lock:
-                        task.output = [p[np.newaxis], v[np.newaxis]]
-                        task.lock.notify() # mark as being complete
+            with self._batch_lock:
+                while True:
+                    if self._stop_worker:
+                        return
+                    batch, full_or_timeout = self._next_batch()
+                    if batch is not None:
+                        break
+                    self._worker_condition.wait(full_or_timeout)
+
+            self._evaluate_batch(batch, full_or_timeout)
+
+    def _evaluate_batch(self, batch, full):
+        start_time = time.perf_counter()
+        count = batch.count
+        policies, values = self._get_output([batch.inputs[:count], 0])
+
+        with self._batch_lock:
+            np.copyto(batch.policies[:count], policies.reshape((count, 12)))
+            np.copyto(batch.values[:count], values.reshape((count, 1)))
+            batch.done = True
+            self._caller_condition.notify_all()
+
+        for slot, callback in batch.callbacks:
+            callback(batch.output(slot))
+
+        # stats
+        with self._lock:
+            stats = self._batch_stats
+            stats['batches'] += 1
+            stats['inputs'] += count
+            stats['full_batches'] += full
+            stats['queue_latency_sum'] += count * start_time - batch.enqueue_time_sum
+            stats['queue_latency_max'] = max(stats['queue_latency_max'], start_time - batch.first_enqueue_time)
+            stats['evaluation_time_sum'] += time.perf_counter() - start_time
+
+    def reset_batch_stats(self):
+        with self._lock:
+            self._batch_stats = {'batches': 0, 'inputs': 0, 'full_batches': 0, 
+                                 'queue_latency_sum': 0., 'queue_latency_max': 0., 'evaluation_time_sum': 0.}
 
-                task_list = []
+    def batch_stats(self):
+        """ Stats of the batches evaluated by the worker thread (latencies in microseconds) """
+        with self._lock:
+            stats = dict(self._batch_stats)
+        batches = max(stats['batches'], 1)
+        inputs = max(stats['inputs'], 1)
+        return {'batches': stats['batches'],
+                'inputs': stats['inputs'],
+                'mean_batch_size': stats['inputs'] / batches,
+                'full_batch_rate': stats['full_batches'] / batches,
+                'mean_queue_latency': 1e6 * stats['queue_latency_sum'] / inputs,
+                'max_queue_latency': 1e6 * stats['queue_latency_max'],
+                'mean_evaluation_time': 1e6 * stats['evaluation_time_sum'] / batches}
 
     def start_worker_thread(self):
+        assert self.max_batch_wait is not None, "max_batch_wait is needed to evaluate the partial batches"
+        with self._batch_lock:
+            self._stop_worker = False
+            if self._filling_buffer is None:
+                self._filling_buffer = BatchBuffer(self.ideal_batch_size)
+                self._spare_buffer = BatchBuffer(self.ideal_batch_size)
+        if self._service is not None:
+            self._service.start()
+            return
         self._worker_thread = threading.Thread(target=self._raw_function_worker, args=())
         self._worker_thread.daemon = True
         self._worker_thread.start()
 
     def stop_worker_thread(self):
-        poison_pill = Task()
-        with poison_pill.lock:
-            poison_pill.kill_thread = True
-            self._queue.put(poison_pill) # put task on queue to be processed
-            poison_pill.lock.wait() # wait for poison pill to be processed
-        self._worker_thread.join() # wait until thread finishes
+        """ Inputs waiting in the buffers are kept for the next worker thread. """
+        if self._service is not None:
+            return # the service keeps running for its other models
+        with self._batch_lock:
+            self._stop_worker = True
+            self._worker_condition.notify()
+        self._worker_thread.join() # wait until thread finishes (after any batch it is evaluating)
         self._worker_thread = None
 
+    def _take_slot(self, input_array):
+        """ Writes the input into the filling buffer (called with the batch lock held). """
+        while self._filling_buffer.count == self._filling_buffer.size:
+            self._caller_condition.wait() # wait for the worker to swap in the empty buffer
+        buffer = self._filling_buffer
+        slot = buffer.write(input_array)
+        if slot == 0 or buffer.count >= self._max_batch_size:
+            self._worker_condition.notify() # start the deadline or evaluate the full batch
+        return buffer, slot
+
     def _raw_function_pass_to_worker(self, input_array):
-        task = Task()
+        with self._batch_lock:
+            buffer, slot = self._take_slot(input_array)
+            buffer.pending_reads += 1
+            while not buffer.done:
+                self._caller_condition.wait() # wait until the batch is evaluated
+            output = buffer.output(slot)
+            buffer.pending_reads -= 1
+            if not buffer.pending_reads:
+                self._worker_condition.notify() # the buffer is free to be reused
+            return output
+
+    def _cache_lookup(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key, last=True)
+                return self._cache[key]
+        return None
+
+    def _process_output(self, output, key):
+        """
+        Reshape the raw output of the network for a single input (and cache it).
+        """
+        policy, value = output
+        policy = policy.reshape((12,))
+        value = value[0, 0]
+
+        if self.use_cache:
+            with self._lock:
+                self._cache[key] = (policy, value)
+                if len(self._cache) > self.max_cache_size:
+                    self._cache.popitem(last=False)
 
-        # put the value on the queue to be processed
-        with task.lock:
-            task.input = input_array
-            self._queue.put(task) # put task on queue to be processed
-            task.lock.wait() # wait until task is processed
-            return task.output # return output
+        return policy, value
 
     def _inner_function(self, input_array):
         """
         The function which computes the output to the array.
         Assume input_array has shape (-1, 56, 4) where -1 represents the history.
         """ 
+        key = None
         if self.use_cache:
             key = input_array.tobytes()
-            if key in self._cache:
-                self._cache.move_to_end(key, last=True)
-                return self._cache[key]
+            cached = self._cache_lookup(key)
+            if cached is not None:
+                return cached
         
         input_array = self.process_single_input(input_array)
         if self.multithreaded:
-            policy, value = self._raw_function_pass_to_worker(input_array)
+            output = self._raw_function_pass_to_worker(input_array)
         else:
-            policy, value = self._raw_function(input_array)
+            output = self._raw_function(input_array)
         
-        policy = policy.reshape((12,))
-        value = value[0, 0]
-
-        if self.use_cache:
-            self._cache[key] = (policy, value)
-            if len(self._cache) > self.max_cache_size:
-                self._cache.popitem(last=False)
-
-        return policy, value
+        return self._process_output(output, key)
 
     def function(self, input_array):
         """
@@ -244,6 +461,59 @@ class BaseModel():
 
         return policy, value
 
+    def batch_function(self, input_arrays):
+        """
+        Evaluates many inputs with one call to the network (directly, not through the 
+        worker thread, and without the cache or rotations).
+        Assume input_arrays has shape (n, -1, 54, 6) where -1 represents the history.
+        Returns the policies (shape (n, 12)) and the values (shape (n, )).
+        """ 
+        inputs = np.concatenate([self.process_single_input(a) for a in input_arrays], axis=0)
+        policies, values = self._raw_function(inputs)
+        return policies.reshape((-1, 12)), values.reshape((-1, ))
+
+    def function_async(self, input_array):
+        """
+        The same as function, but returns a concurrent.futures.Future for the 
+        (policy, value) pair.  If multithreaded, the input is passed to the worker
+        and the caller can keep working while the batch is filled and evaluated.
+        Otherwise, the returned future is already done.
+        """
+        future = Future()
+        if not self.multithreaded:
+            future.set_result(self.function(input_array))
+            return future
+
+        rotation_id = None
+        if self.rotationally_randomize:
+            rotation_id = np.random.choice(48)
+            input_array = randomize_input(input_array, rotation_id)
+
+        key = None
+        if self.use_cache:
+            key = input_array.tobytes()
+            cached = self._cache_lookup(key)
+            if cached is not None:
+                policy, value = cached
+                if rotation_id is not None:
+                    policy = derandomize_policy(policy, rotation_id)
+                future.set_result((policy, value))
+                return future
+
+        def finish(output):
+            # called by the worker thread
+            policy, value = self._process_output(output, key)
+            if rotation_id is not None:
+                policy = derandomize_policy(policy, rotation_id)
+            future.set_result((policy, value))
+
+        input_array = self.process_single_input(input_array)
+        with self._batch_lock:
+            buffer, slot = self._take_slot(input_array)
+            buffer.callbacks.append((slot, finish))
+
+        return future
+
     def load_from_file(self, path):
         self._model.load_weights(path)
         self._rebuild_function()
@@ -549,52 +819,7 @@ class ConvModel2D3D(BaseModel):
 
         import tensorflow as tf
 
-        from model_constant_arrays import x3d, y3d, z3d, neighbors
-        neighbors[neighbors == -1] = 54
-        
-        def special_cube_conv(in_tensor, filter_size):
-            """
-            Takes in a None (samples) x 54 x ? (filters) tensor.
-
-            It embedds it into 5 x 5 grid, and does a 3D convolution
-            using only the nodes in the orginal embedding.
-
-            To speed things up, it actually does the folowing:
-            - pads the end with a zero (in the last dimension):
-                None (samples) x 55 x ? (filters) (neighbors)
-            - align neighbors to get an output of dim:
-                None (samples) x 54 x 27 x ? (filters) (neighbors)
-            - 2d convolution with filter (1, 27) and no padding to get an output of dim:
-                None (samples) x 54 x filter_size
-            - reshape to remove last dimension:
-                None (samples) x filter_size x 54
-            """ 
-            assert in_tensor.shape[1] == 54, in_tensor.shape
-
-            # pad (output dim: None x 55 x ?)
-            padded = Lambda(lambda x: K.temporal_padding(x, (0, 1)))(in_tensor) # just pad end
-            assert padded.shape[1] == 55, padded.shape
-            
-            # align neighbors (output dim: None x 54 x 27 x ?)
-            #aligned = K.gather(padded, neighbors)
-            #aligned = padded[ neighbors[np.newaxis].astype(np.int32), :]
-            aligned = Lambda(lambda x: tf.gather(x, neighbors, axis=1))(padded)
-            assert aligned.shape[1:3] == (54, 27), aligned.shape
-            
-            # 2D convolution in one axis (output dim: None x 54 x 1 x filter_size)
-            conv = Conv2D(filter_size, kernel_size=(1, 27), 
-                          strides=(1, 1), 
-                          padding='valid', 
-                          data_format="channels_last",
-                          kernel_regularizer=l2(0.001), 
-                          bias_regularizer=l2(0.001))(aligned)
-            assert conv.shape[1:3] == (54, 1), conv.shape
-
-            # reshape (output dim: None x 54 x filter_size)
-            out_tensor = Lambda(lambda x: K.squeeze(x, axis=2))(conv)
-            assert out_tensor.shape[1] == 54, out_tensor.shape
-
-            return out_tensor
+        special_cube_conv = self.special_cube_conv
 
         def conv_block(in_tensor, filter_size):
             conv = special_cube_conv(in_tensor, filter_size)
@@ -667,6 +892,115 @@ class ConvModel2D3D(BaseModel):
 
         self._build(model)
 
+    def special_cube_conv(self, in_tensor, filter_size):
+        """
+        Takes in a None (samples) x 54 x ? (filters) tensor.
+
+        It embedds it into 5 x 5 grid, and does a 3D convolution
+        using only the nodes in the orginal embedding.
+
+        To speed things up, it actually does the folowing:
+        - pads the end with a zero (in the last dimension):
+            None (samples) x 55 x ? (filters) (neighbors)
+        - align neighbors to get an output of dim:
+            None (samples) x 54 x 27 x ? (filters) (neighbors)
+        - 2d convolution with filter (1, 27) and no padding to get an output of dim:
+            None (samples) x 54 x filter_size
+        - reshape to remove last dimension:
+            None (samples) x filter_size x 54
+        """ 
+        from keras.layers import Conv2D, Lambda
+        from keras.regularizers import l2
+        import keras.backend as K
+        import tensorflow as tf
+
+        from model_constant_arrays import neighbors
+        neighbors = np.where(neighbors == -1, 54, neighbors) # -1 (off the cube) is the zero padding
+
+        assert in_tensor.shape[1] == 54, in_tensor.shape
+
+        # pad (output dim: None x 55 x ?)
+        padded = Lambda(lambda x: K.temporal_padding(x, (0, 1)))(in_tensor) # just pad end
+        assert padded.shape[1] == 55, padded.shape
+        
+        # align neighbors (output dim: None x 54 x 27 x ?)
+        #aligned = K.gather(padded, neighbors)
+        #aligned = padded[ neighbors[np.newaxis].astype(np.int32), :]
+        aligned = Lambda(lambda x: tf.gather(x, neighbors, axis=1))(padded)
+        assert aligned.shape[1:3] == (54, 27), aligned.shape
+        
+        # 2D convolution in one axis (output dim: None x 54 x 1 x filter_size)
+        conv = Conv2D(filter_size, kernel_size=(1, 27), 
+                      strides=(1, 1), 
+                      padding='valid', 
+                      data_format="channels_last",
+                      kernel_regularizer=l2(0.001), 
+                      bias_regularizer=l2(0.001))(aligned)
+        assert conv.shape[1:3] == (54, 1), conv.shape
+
+        # reshape (output dim: None x 54 x filter_size)
+        out_tensor = Lambda(lambda x: K.squeeze(x, axis=2))(conv)
+        assert out_tensor.shape[1] == 54, out_tensor.shape
+
+        return out_tensor
+
+    def numpy_weights(self):
+        """
+        The weights of the network as a dict of arrays for NumpyConvModel2D3D, with each 
+        BatchNormalization folded into the convolution before it.  (The batch normalization 
+        is over axis 1, i.e. per position, so it becomes a scale (54, ) and a bias (54, filters).)
+        """
+        from keras.layers import BatchNormalization, Dense
+
+        # the layers in the order they were created in build
+        def creation_order(layer):
+            return int(layer.name.rsplit('_', 1)[-1])
+        convs = sorted([l for l in self._model.layers if l.weights and len(l.weights[0].shape) == 4], # kernels (1, 27, ?, filters)
+                       key=creation_order)
+        batch_norms = sorted([l for l in self._model.layers if isinstance(l, BatchNormalization)], key=creation_order)
+        hidden_denses = sorted([l for l in self._model.layers if isinstance(l, Dense) and not l.name.endswith('_output')], 
+                               key=creation_order)
+        assert len(convs) == len(batch_norms) and len(convs) % 2 == 1 and len(hidden_denses) == 2, "unexpected architecture"
+
+        # convolutions: the input block, the residual blocks, then the policy and value heads
+        weights = {'residual_blocks': np.array((len(convs) - 3) // 2)}
+        for i, (conv, batch_norm) in enumerate(zip(convs, batch_norms)):
+            kernel, bias = conv.get_weights()
+            gamma, beta, mean, variance = batch_norm.get_weights()
+            scale = gamma / np.sqrt(variance + batch_norm.epsilon)
+            weights['conv{}_kernel'.format(i)] = kernel.reshape((27, ) + kernel.shape[2:])
+            weights['conv{}_scale'.format(i)] = scale
+            weights['conv{}_bias'.format(i)] = scale[:, np.newaxis] * bias + (beta - mean * scale)[:, np.newaxis]
+
+        for name, dense in [('policy_hidden', hidden_denses[0]), ('value_hidden', hidden_denses[1]), 
+                            ('policy_output', self._model.get_layer('policy_output')), 
+                            ('value_output', self._model.get_layer('value_output'))]:
+            kernel, bias = dense.get_weights()
+            weights[name + '_kernel'] = kernel
+            weights[name + '_bias'] = bias
+
+        return {k: v.astype(np.float32) if k != 'residual_blocks' else v for k, v in weights.items()}
+
+    def export_numpy(self, path, check_size=64, tolerance=1e-5):
+        """
+        Save the weights for NumpyConvModel2D3D (as an .npz file), and check that its outputs 
+        match this model on check_size random cubes.  Returns the largest difference.
+        """
+        np.savez(path, **self.numpy_weights())
+
+        numpy_model = NumpyConvModel2D3D(use_cache=False, history=self.history)
+        numpy_model.load_from_file(path if str(path).endswith('.npz') else str(path) + '.npz')
+
+        cubes = BatchCube(check_size)
+        cubes.randomize(100)
+        inputs = cubes.bit_array().reshape((check_size, 1, 54, 6)).repeat(self.history, axis=1)
+        policies, values = self.batch_function(inputs)
+        numpy_policies, numpy_values = numpy_model.batch_function(inputs)
+        difference = max(np.abs(policies - numpy_policies).max(), np.abs(values - numpy_values).max())
+        if difference > tolerance:
+            warnings.warn("The NumPy model differs from the Keras model by {}".format(difference), stacklevel=2)
+        return difference
+
     def process_single_input(self, input_array):
         input_array = input_array.reshape((self.history, 54, 6))
         if self.history > 1:
@@ -719,3 +1053,179 @@ class ConvModel2D3D(BaseModel):
 
         return inputs, policies, values
 
+
+class NumpyConvModel2D3D(ConvModel2D3D):
+    """
+    ConvModel2D3D for inference only, in NumPy (without Keras/TensorFlow, e.g. for worker processes).
+    Load the weights exported by ConvModel2D3D.export_numpy with load_from_file.
+
+    The convolutions gather the neighbors of each position and multiply by the kernel.  A single
+    input uses one gather and matmul over all 27 kernel offsets.  Larger batches skip the offsets
+    which are off the cube (about two thirds), with one gather and matmul per offset.
+    """
+    def __init__(self, use_cache=True, max_cache_size=10000, rotationally_randomize=False, history=1):
+        ConvModel2D3D.__init__(self, use_cache, max_cache_size, rotationally_randomize, history)
+        self._weights = None
+
+        from model_constant_arrays import neighbors
+        valid = (neighbors >= 0) & (neighbors < 54) # (ConvModel2D3D.build replaces the -1s with 54)
+        self._padded_neighbors = np.where(valid, neighbors, 54)
+        self._offsets = [(np.nonzero(valid[:, k])[0], neighbors[valid[:, k], k]) for k in range(27)] # (positions, neighbors)
+
+    def build(self):
+        """
+        There is nothing to build (the network is given by the weights in load_from_file).
+        """
+        pass
+
+    def _rebuild_function(self):
+        self._cache = OrderedDict()
+        self.weights_version += 1
+        self._get_output = self._forward
+
+        if self.multithreaded:
+            if self._worker_thread is not None:
+                self.stop_worker_thread()
+            self.start_worker_thread()
+
+    def load_from_file(self, path):
+        with np.load(path) as weights:
+            self._weights = dict(weights)
+        self._rebuild_function()
+
+    def save_to_file(self, path):
+        np.savez(path, **self._weights)
+
+    def train_on_data(self, data):
+        warnings.warn("'NumpyConvModel2D3D' can't be trained.  Train a ConvModel2D3D and export it.", stacklevel=2)
+
+    def _conv(self, x, i):
+        """ The convolution i (with the batch normalization folded in) """
+        kernel = self._weights['conv{}_kernel'.format(i)]
+        if len(x) == 1:
+            padded = np.concatenate([x, np.zeros((1, 1, x.shape[2]), dtype=x.dtype)], axis=1)
+            aligned = padded[:, self._padded_neighbors].reshape((54, -1))
+            out = (aligned @ kernel.reshape((-1, kernel.shape[2]))).reshape((1, 54, -1))
+        else:
+            out = np.zeros((len(x), 54, kernel.shape[2]), dtype=np.float32)
+            for kernel_k, (positions, neighbors) in zip(kernel, self._offsets):
+                out[:, positions] += x[:, neighbors] @ kernel_k
+        
+        out *= self._weights['conv{}_scale'.format(i)][:, np.newaxis]
+        out += self._weights['conv{}_bias'.format(i)]
+        return out
+
+    def _dense(self, x, name):
+        return x @ self._weights[name + '_kernel'] + self._weights[name + '_bias']
+
+    def _forward(self, args):
+        """ Used in place of the Keras function: takes [inputs, learning phase] and returns [policies, values] """
+        x = np.asarray(args[0], dtype=np.float32)
+        relu = lambda a: np.maximum(a, 0)
+
+        block = relu(self._conv(x, 0))
+        residual_blocks = int(self._weights['residual_blocks'])
+        for r in range(residual_blocks):
+            hidden = relu(self._conv(block, 2 * r + 1))
+            block = relu(self._conv(hidden, 2 * r + 2) + block)
+
+        i = 2 * residual_blocks + 1
+        policy_flat = relu(self._conv(block, i)).reshape((len(x), -1))
+        logits = self._dense(relu(self._dense(policy_flat, 'policy_hidden')), 'policy_output')
+        exp_logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+        policies = exp_logits / exp_logits.sum(axis=1, keepdims=True)
+
+        value_flat = relu(self._conv(block, i + 1)).reshape((len(x), -1))
+        values = 1 / (1 + np.exp(-self._dense(relu(self._dense(value_flat, 'value_hidden')), 'value_output')))
+
+        return [policies, values]
+
+
+_cube_conv_class = None
+
+def cube_conv_class():
+    """
+    The Keras layer for ConvModel2D3DLowMemory (defined on first use so Keras is only imported when needed).
+    """
+    global _cube_conv_class
+    if _cube_conv_class is not None:
+        return _cube_conv_class
+
+    from keras.layers import Layer
+    from keras import initializers, regularizers
+    import keras.backend as K
+    import tensorflow as tf
+
+    from model_constant_arrays import neighbors
+
+    # the (position, neighbor) pairs on the cube, grouped by kernel offset
+    valid = (neighbors >= 0) & (neighbors < 54)
+    offsets, positions = np.nonzero(valid.T)
+    sources = neighbors[positions, offsets]
+    offset_ends = np.cumsum(np.bincount(offsets, minlength=27))
+
+    class CubeConv(Layer):
+        """
+        The same convolution as ConvModel2D3D.special_cube_conv (with the same weights), 
+        but only gathering the neighbors which are on the cube, one matrix product for
+        each kernel offset, and summing the products into the positions.
+        Takes in a None (samples) x 54 x ? (filters) tensor.
+        """
+        def __init__(self, filters, kernel_regularizer=None, bias_regularizer=None, **kwargs):
+            Layer.__init__(self, **kwargs)
+            self.filters = filters
+            self.kernel_regularizer = regularizers.get(kernel_regularizer)
+            self.bias_regularizer = regularizers.get(bias_regularizer)
+
+        def build(self, input_shape):
+            # the same shapes as the kernel and bias of Conv2D(filters, kernel_size=(1, 27))
+            self.kernel = self.add_weight(name='kernel', shape=(1, 27, int(input_shape[-1]), self.filters),
+                                          initializer=initializers.get('glorot_uniform'),
+                                          regularizer=self.kernel_regularizer)
+            self.bias = self.add_weight(name='bias', shape=(self.filters, ),
+                                        initializer=initializers.get('zeros'),
+                                        regularizer=self.bias_regularizer)
+            Layer.build(self, input_shape)
+
+        def call(self, x):
+            # gather the neighbors on the cube (output dim: None x 462 x ?)
+            gathered = tf.gather(x, sources, axis=1)
+
+            # multiply by the kernel at each offset (output dim: None x 462 x filters)
+            products = []
+            start = 0
+            for offset, end in enumerate(offset_ends):
+                if end > start:
+                    products.append(K.dot(gathered[:, start:end], self.kernel[0, offset]))
+                start = end
+            products = K.concatenate(products, axis=1)
+
+            # sum into the positions (output dim: None x 54 x filters)
+            summed = tf.unsorted_segment_sum(tf.transpose(products, (1, 0, 2)), positions, 54)
+            return tf.transpose(summed, (1, 0, 2)) + self.bias
+
+        def compute_output_shape(self, input_shape):
+            return (input_shape[0], 54, self.filters)
+
+        def get_config(self):
+            config = {'filters': self.filters,
+                      'kernel_regularizer': regularizers.serialize(self.kernel_regularizer),
+                      'bias_regularizer': regularizers.serialize(self.bias_regularizer)}
+            config.update(Layer.get_config(self))
+            return config
+
+    _cube_conv_class = CubeConv
+    return CubeConv
+
+class ConvModel2D3DLowMemory(ConvModel2D3D):
+    """
+    ConvModel2D3D with a convolution which doesn't build the None x 54 x 27 x filters tensor of 
+    aligned neighbors (only the neighbors on the cube, about a third of them, are gathered).  
+    The weights are the same, so weights saved by either model can be loaded by the other.
+    """
+    def special_cube_conv(self, in_tensor, filter_size):
+        from keras.regularizers import l2
+
+        assert in_tensor.shape[1] == 54, in_tensor.shape
+        CubeConv = cube_conv_class()
+        return CubeConv(filter_size, kernel_regularizer=l2(0.001), bias_regularizer=l2(0.001))(in_tensor)
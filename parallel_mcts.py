@@ -0,0 +1,278 @@
+"""
+Root-parallel MCTS over worker processes.
+
+The tree search itself is Python and so is limited to one core by the GIL.  For
+hard positions (e.g. in evaluation), ParallelMCTSAgent runs one independent
+MCTSAgent per worker process, all from the same root but with different
+Dirichlet noise, and merges their root statistics (visit counts and action
+values are summed).  It has the same interface as MCTSAgent for playing moves
+(search, action_visit_counts, action_probabilities, best_action,
+advance_to_action, is_terminal, stats), so it can be used in its place when
+playing.  (It doesn't support warm_start or the other tree methods, so it is
+not a replacement inside BatchGameAgent.)
+
+Each worker needs its own copy of the network, so the agent takes a model
+factory: a picklable callable (such as ModelLoader) which builds the model in the
+worker process.  The workers are started with 'spawn' (forking a process which
+has already started TensorFlow is not safe).
+"""
+import multiprocessing
+import numpy as np
+import time
+import warnings
+from mcts_nn_cube import MCTSAgent, State, action_count
+
+class ModelLoader():
+    """ A picklable model factory: builds the model of the given type and loads its weights (if a path is given). """
+    def __init__(self, model_type, model_kwargs, weights_path=None):
+        self.model_type = model_type
+        self.model_kwargs = model_kwargs
+        self.weights_path = weights_path
+
+    def __call__(self):
+        import models
+        model = models.__dict__[self.model_type](**self.model_kwargs)
+        model.build()
+        if self.weights_path is not None:
+            model.load_from_file(self.weights_path)
+        return model
+
+_root_stat_keys = ['visit_counts', 'total_action_values', 'shortest_path', 'shortest_path_action', 'prior',
+                   'prior_dirichlet', 'value', 'proven_distance', 'simulations_saved', 'simulations_reused', 'search']
+
+def _root_stats(mcts):
+    return {key: mcts.stats(key) for key in _root_stat_keys}
+
+def _merge_search_stats(search_stats_list):
+    """ Sums the SearchStats dicts (padding the leaf depth histograms to the same length) """
+    merged = {}
+    for search_stats in search_stats_list:
+        for key, value in search_stats.items():
+            if key not in merged:
+                merged[key] = value
+            elif key == 'leaf_depth_histogram':
+                length = max(len(merged[key]), len(value))
+                merged[key] = np.pad(merged[key], (0, length - len(merged[key]))) + np.pad(value, (0, length - len(value)))
+            else:
+                merged[key] = merged[key] + value
+    return merged
+
+def _worker(connection, model_factory, seed, agent_kwargs):
+    try:
+        np.random.seed(seed) # so that each worker uses different Dirichlet noise
+        model = model_factory()
+        mcts = None
+
+        while True:
+            command, argument = connection.recv()
+            if command == 'reset':
+                mcts = MCTSAgent(model.function, State(_frames=argument), transposition_table={}, **agent_kwargs)
+                connection.send(_root_stats(mcts))
+            elif command == 'search':
+                steps, deadline, max_nodes = argument
+                mcts.search(steps=steps, deadline=deadline, max_nodes=max_nodes)
+                connection.send(_root_stats(mcts))
+            elif command == 'advance':
+                mcts.advance_to_action(argument)
+                connection.send(_root_stats(mcts))
+            elif command == 'stop':
+                connection.close()
+                return
+    except Exception as e:
+        # passed to the parent, which raises it
+        try:
+            connection.send(e)
+        except Exception:
+            connection.send(RuntimeError("worker failed with {!r}".format(e)))
+
+class ParallelMCTSAgent():
+    """
+    Runs an MCTSAgent in each of the worker processes and merges their root statistics.
+    The other keyword arguments are passed to the MCTSAgents.
+
+    - sync_steps: the number of simulations each worker runs between merges.  (More
+      frequent merges let early stopping act sooner, but cost more communication.)
+    """
+    def __init__(self, model_factory, initial_state, max_depth, workers=4, sync_steps=100, seed=None, **agent_kwargs):
+        self.max_depth = max_depth
+        self.sync_steps = sync_steps
+        # early stopping is only checked here, on the merged statistics (the workers' own 
+        # checks would only see their round of sync_steps simulations)
+        self.early_stopping = agent_kwargs.pop('early_stopping', False)
+        self.root_state = initial_state
+        self.total_steps = 0
+
+        agent_kwargs['max_depth'] = max_depth
+        if seed is None:
+            seed = np.random.randint(2**31 - workers)
+        context = multiprocessing.get_context('spawn')
+        self._connections = []
+        self._processes = []
+        for i in range(workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=_worker, args=(child_connection, model_factory, seed + i, agent_kwargs))
+            process.daemon = True
+            process.start()
+            child_connection.close() # (so that recv fails if the worker exits)
+            self._connections.append(parent_connection)
+            self._processes.append(process)
+
+        self.simulations_saved = 0
+        try:
+            self._worker_stats = self._broadcast('reset', initial_state._frames)
+        except Exception:
+            self.close()
+            raise
+        self._search_stats = [stats['search'] for stats in self._worker_stats] # of the last search, summed over its rounds
+
+    def _broadcast(self, command, arguments):
+        """ Sends the command to every worker (with arguments[i] to worker i) and returns their replies. """
+        if not isinstance(arguments, list):
+            arguments = [arguments] * len(self._connections)
+        for connection, argument in zip(self._connections, arguments):
+            connection.send((command, argument))
+        return [self._receive(connection, process) for connection, process in zip(self._connections, self._processes)]
+
+    @staticmethod
+    def _receive(connection, process):
+        # poll instead of blocking, in case the worker died without replying
+        while not connection.poll(0.1):
+            if not process.is_alive():
+                raise RuntimeError("MCTS worker process exited (exit code {})".format(process.exitcode))
+        try:
+            reply = connection.recv()
+        except EOFError:
+            raise RuntimeError("MCTS worker process exited (exit code {})".format(process.exitcode))
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def _merged(self, key):
+        return sum(stats[key] for stats in self._worker_stats)
+
+    def close(self):
+        """ Stop the worker processes. """
+        for connection, process in zip(self._connections, self._processes):
+            if process.is_alive():
+                try:
+                    connection.send(('stop', None))
+                except (BrokenPipeError, EOFError, OSError):
+                    pass
+        for process in self._processes:
+            process.join()
+        self._connections = []
+        self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def search(self, steps=None, deadline=None, max_nodes=None):
+        """
+        The same budgets as MCTSAgent.search, split between the workers: steps simulations and
+        max_nodes new nodes in total, and the deadline (time.time()) for each worker.  The root 
+        statistics are merged every sync_steps simulations per worker (stopping early once 
+        settled, if early_stopping).
+        """
+        assert steps is not None or deadline is not None or max_nodes is not None, "no search budget given"
+        if self.is_terminal():
+            return
+        workers = len(self._connections)
+        self._search_stats = [{} for _ in range(workers)]
+        self.simulations_saved = 0
+
+        worker_steps = None if steps is None else int(np.ceil(steps / workers))
+        worker_nodes = None if max_nodes is None else [int(np.ceil(max_nodes / workers))] * workers
+        done_steps = 0
+        while worker_steps is None or done_steps < worker_steps:
+            if done_steps and ((deadline is not None and time.time() >= deadline) or 
+                               (worker_nodes is not None and max(worker_nodes) <= 0)):
+                break
+
+            round_steps = self.sync_steps if worker_steps is None else min(self.sync_steps, worker_steps - done_steps)
+            arguments = [(round_steps, deadline, None if worker_nodes is None else max(0, worker_nodes[i])) 
+                         for i in range(workers)]
+            self._worker_stats = self._broadcast('search', arguments)
+            done_steps += round_steps
+
+            simulations = 0
+            for i, stats in enumerate(self._worker_stats):
+                self._search_stats[i] = _merge_search_stats([self._search_stats[i], stats['search']])
+                simulations += stats['search']['simulations']
+                if worker_nodes is not None:
+                    worker_nodes[i] -= stats['search']['nodes_created']
+            self.total_steps += simulations
+            if not simulations:
+                break # nothing left to search
+
+            remaining_steps = None if worker_steps is None else (worker_steps - done_steps) * workers
+            if self.early_stopping and self.search_is_settled(remaining_steps):
+                self.simulations_saved = remaining_steps or 0
+                break
+
+    def search_is_settled(self, remaining_steps):
+        """ The same test as MCTSAgent.search_is_settled on the merged statistics. """
+        visit_counts = self.action_visit_counts()
+        best_action = np.argmax(visit_counts)
+
+        shortest_paths = [(stats['shortest_path'], stats['shortest_path_action']) for stats in self._worker_stats
+                          if stats['shortest_path'] >= 0]
+        if shortest_paths and min(shortest_paths)[1] == best_action:
+            return True
+
+        if remaining_steps is None:
+            return False
+
+        second_most, most = np.partition(visit_counts, action_count - 2)[-2:]
+        return most - second_most > remaining_steps
+
+    def action_visit_counts(self):
+        return self._merged('visit_counts')
+
+    def action_probabilities(self, inv_temp):
+        visit_counts = self.action_visit_counts()
+        if not visit_counts.sum():
+            return None
+
+        exponentiated_visit_counts = (visit_counts / visit_counts.sum()) ** inv_temp
+        return exponentiated_visit_counts / exponentiated_visit_counts.sum()
+
+    def best_action(self):
+        return np.argmax(self.action_visit_counts())
+
+    def is_terminal(self):
+        return self.root_state.done()
+
+    def advance_to_best_child(self):
+        self.advance_to_action(self.best_action())
+
+    def advance_to_action(self, action):
+        """ Advance all the workers' trees (each keeps its own subtree). """
+        self._worker_stats = self._broadcast('advance', action)
+        self.root_state = self.root_state.next(action)
+
+    def stats(self, key):
+        """ 
+        Provides the merged stats (or those of the first worker for the network outputs at the root, 
+        and its Dirichlet noised prior)
+        """
+        if key in ('shortest_path', 'proven_distance'):
+            values = [stats[key] for stats in self._worker_stats if stats[key] >= 0]
+            return min(values) if values else -1
+        elif key == 'shortest_path_action':
+            paths = [(stats['shortest_path'], stats['shortest_path_action']) for stats in self._worker_stats 
+                     if stats['shortest_path'] >= 0]
+            return min(paths)[1] if paths else -1
+        elif key in ('visit_counts', 'total_action_values', 'simulations_reused'):
+            return self._merged(key)
+        elif key == 'simulations_saved':
+            return self.simulations_saved
+        elif key == 'search':
+            return _merge_search_stats(self._search_stats)
+        elif key in ('prior', 'prior_dirichlet', 'value'):
+            return self._worker_stats[0][key]
+        else:
+            warnings.warn("'{}' argument not implemented for stats".format(key), stacklevel=2)
+            return None
@@ -0,0 +1,59 @@
+"""
+A cache of completed root searches.
+
+At low curriculum levels the same few scrambles are played over and over, and
+each one gets a fresh search.  This cache keeps the root statistics of the last
+search at each state (visit counts, action values, and the shortest path found),
+so that a later search at the same state (with the same model weights) can be
+warm-started from them (see MCTSAgent.warm_start) and only run the remaining
+simulations.
+"""
+from collections import namedtuple, OrderedDict
+import threading
+
+SearchResult = namedtuple('SearchResult', ['visit_counts', 'total_action_values',
+                                           'shortest_path', 'shortest_path_action'])
+
+class SearchResultCache():
+    """
+    A bounded (least recently used) thread-safe cache from (state, model weights) to SearchResults.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # stats
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def key(mcts, model):
+        """ The key of the root of the MCTSAgent when searched with the given model. """
+        return (mcts.initial_node.state.key(), id(model), model.weights_version)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            self.lookups += 1
+            result = self._entries.get(key)
+            if result is not None:
+                self.hits += 1
+                self._entries.move_to_end(key, last=True)
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key, last=True)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'lookups': self.lookups,
+                    'hits': self.hits,
+                    'hit_rate': self.hits / self.lookups if self.lookups else 0.}
@@ -0,0 +1,257 @@
+"""
+A batched best-first solver for pure solving (no training data), using the value
+network as a heuristic.
+
+The MCTS spends hundreds of simulations (and network calls) per move.  Here, the
+network's value is turned into an estimated distance to the solved cube,
+    distance ~ log(value) / log(gamma)
+(since the network is trained to predict gamma ** distance), and each cube is
+solved by weighted A* (f = g + weight * h) or beam search.  All the cubes are
+searched together: each iteration expands the best states of every search at
+once and evaluates all the new states in one batched call to the network.
+States are deduplicated by BatchSolver._keys: the bytes of each cube's bit array,
+packed with np.packbits.
+
+solve_many is the same kind of entry point for the MCTS: it plays out many
+MCTSAgents concurrently (sharing the model's batching worker thread) and
+streams the results back as each cube finishes.
+"""
+from collections import namedtuple
+import heapq
+import numpy as np
+import queue
+import threading
+import time
+from batch_cube import BatchCube
+
+action_count = 12
+
+# values are clipped to this before taking the log (so the distance is finite)
+min_value = 1e-6
+
+class _Search():
+    """ The search for one cube. """
+    def __init__(self, cube_array, root_key):
+        self.nodes = {root_key: (None, None, 0, cube_array)} # key -> (parent key, action, g, cube array)
+        self.frontier = [(0., 0, root_key)] # heap of (f, tie breaker, key)
+        self.solution = None
+        self.done = False
+
+    def path_to(self, key):
+        actions = []
+        parent_key, action, _, _ = self.nodes[key]
+        while parent_key is not None:
+            actions.append(action)
+            parent_key, action, _, _ = self.nodes[parent_key]
+        return actions[::-1]
+
+class BatchSolver():
+    """
+    Solves many cubes in parallel with batched weighted A* (mode='astar') or
+    beam search (mode='beam').
+
+    - expansions: the number of states expanded per cube and iteration (the beam width for beam search)
+    - weight: the weight of the heuristic (1 is A*, larger is greedier)
+    - gamma: the decay used to train the value of the model
+    """
+    def __init__(self, model, mode='astar', expansions=16, weight=1.0, gamma=.95):
+        assert mode in ('astar', 'beam'), "mode must be 'astar' or 'beam'"
+        assert model.history == 1, "the solver does not support models with history"
+
+        self.model = model
+        self.mode = mode
+        self.expansions = expansions
+        self.weight = weight
+        self.gamma = gamma
+
+        # stats for the last call to solve
+        self.iterations = 0
+        self.nodes_evaluated = 0
+        self.solve_time = 0.
+
+    def heuristic(self, values):
+        """ The estimated distances to the solved cube from the values of the network. """
+        return np.log(np.maximum(values, min_value)) / np.log(self.gamma)
+
+    def solve(self, cubes, max_iterations=100, max_nodes=None):
+        """
+        Takes a BatchCube and returns a list with, for each cube, the list of actions
+        solving it (or None if no solution was found within the budget).
+        The search for a cube stops once it has max_nodes states (if not None).
+        """
+        start_time = time.time()
+        self.iterations = 0
+        self.nodes_evaluated = 0
+
+        cube_arrays = cubes._cube_array.astype(np.uint8)
+        searches = [_Search(cube_array, key) for cube_array, key in zip(cube_arrays, self._keys(cubes))]
+        for search, done in zip(searches, cubes.done()):
+            if done:
+                search.solution = []
+                search.done = True
+
+        tie_breaker = 1
+        while self.iterations < max_iterations:
+            active = [search for search in searches if not search.done]
+            if not active:
+                break
+            self.iterations += 1
+
+            # pop the best states of each search
+            expanded = [] # (search, key)
+            for search in active:
+                if not search.frontier:
+                    search.done = True # nothing left to search
+                    continue
+                for _ in range(min(self.expansions, len(search.frontier))):
+                    _, _, key = heapq.heappop(search.frontier)
+                    expanded.append((search, key))
+                if self.mode == 'beam':
+                    search.frontier = []
+
+            if not expanded:
+                break
+
+            # apply all the actions to all the expanded states at once
+            children = BatchCube(cube_array=np.array([search.nodes[key][3] for search, key in expanded]))
+            children.step_independent(np.arange(action_count))
+            child_keys = self._keys(children)
+            child_done = children.done()
+            child_arrays = children._cube_array.astype(np.uint8)
+
+            # record new states (and solutions)
+            new_children = [] # (search, key, g, index in children)
+            for i, (search, parent_key) in enumerate(expanded):
+                if search.done:
+                    continue
+                g = search.nodes[parent_key][2] + 1
+                for action in range(action_count):
+                    j = i * action_count + action
+                    key = child_keys[j]
+                    if key in search.nodes:
+                        continue
+                    search.nodes[key] = (parent_key, action, g, child_arrays[j])
+                    if child_done[j]:
+                        search.solution = search.path_to(key)
+                        search.done = True
+                        break
+                    new_children.append((search, key, g, j))
+
+            # evaluate the new states (of the unsolved searches) in one batch
+            new_children = [child for child in new_children if not child[0].done]
+            if new_children:
+                indices = [j for _, _, _, j in new_children]
+                bit_arrays = BatchCube(cube_array=children._cube_array[indices]).bit_array()
+                _, values = self.model.batch_function(bit_arrays.reshape((-1, 1, 54, 6)))
+                h = self.heuristic(values)
+                self.nodes_evaluated += len(new_children)
+
+                for (search, key, g, _), h_i in zip(new_children, h):
+                    heapq.heappush(search.frontier, (g + self.weight * h_i, tie_breaker, key))
+                    tie_breaker += 1
+
+            for search in active:
+                if self.mode == 'beam' and len(search.frontier) > self.expansions:
+                    search.frontier = heapq.nsmallest(self.expansions, search.frontier)
+                    heapq.heapify(search.frontier)
+                if max_nodes is not None and len(search.nodes) >= max_nodes:
+                    search.done = True
+
+        self.solve_time = time.time() - start_time
+        return [search.solution for search in searches]
+
+    @staticmethod
+    def _keys(cubes):
+        size = len(cubes)
+        packed = np.packbits(cubes.bit_array().reshape((size, -1)), axis=1)
+        return [row.tobytes() for row in packed]
+
+SolveResult = namedtuple('SolveResult', ['index',       # position of the cube in the input
+                                         'solution',    # list of actions, or None if not solved
+                                         'simulations', # MCTS simulations used on this cube
+                                         'solve_time',  # seconds spent on this cube
+                                         'throughput']) # cubes finished per second so far (over all cubes)
+
+def solve_many(cubes, model, budget=800, max_moves=50, concurrency=32, max_depth=50, gamma=.95, 
+               c_puct=1.0, endgame_oracle=None):
+    """
+    Solves the cubes (a BatchCube, or a list of BatchCubes of length 1) with one MCTSAgent
+    each, using budget simulations per move and at most max_moves moves.
+
+    This is a generator which yields a SolveResult for each cube as soon as it finishes
+    (not in order).  Up to concurrency cubes are searched at once, each in its own thread,
+    so that the model's worker thread can batch their network calls.  (If the model is
+    not multithreaded, the cubes are solved one at a time.)
+    """
+    from mcts_nn_cube import State, MCTSAgent
+
+    if isinstance(cubes, BatchCube):
+        cubes = [BatchCube(cube_array=cube_array[np.newaxis].copy()) for cube_array in cubes._cube_array]
+    if not cubes:
+        return
+
+    def solve_one(cube):
+        state = State.from_cube(cube, history=model.history)
+        mcts = MCTSAgent(model.function, state, 
+                         max_depth=max_depth, 
+                         transposition_table={},
+                         c_puct=c_puct,
+                         gamma=gamma,
+                         dirichlet_const=None,
+                         early_stopping=True,
+                         mcts_solver=True,
+                         endgame_oracle=endgame_oracle,
+                         detect_cycles=True,
+                         use_symmetry=model.history == 1)
+
+        solution = []
+        while not mcts.is_terminal():
+            if len(solution) == max_moves:
+                return None, mcts.total_steps
+            mcts.search(steps=budget)
+            if mcts.stats('proven_distance') >= 0 and mcts.stats('shortest_path_action') >= 0:
+                # follow the proven path (the visit counts may lead back and forth between proven nodes)
+                action = mcts.stats('shortest_path_action')
+            else:
+                action = np.argmax(mcts.action_visit_counts())
+            mcts.advance_to_action(action)
+            solution.append(action)
+        return solution, mcts.total_steps
+
+    thread_count = max(1, min(concurrency, len(cubes))) if model.multithreaded else 1
+    tasks = queue.Queue()
+    for i, cube in enumerate(cubes):
+        tasks.put((i, cube))
+    results = queue.Queue()
+
+    def run_thread():
+        try:
+            while True:
+                try:
+                    i, cube = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                t = time.time()
+                solution, simulations = solve_one(cube)
+                results.put((i, solution, simulations, time.time() - t))
+        except Exception as e:
+            results.put(e) # raised by the generator
+
+    if model.multithreaded:
+        model.set_max_batch_size(thread_count)
+    
+    start_time = time.time()
+    threads = [threading.Thread(target=run_thread) for _ in range(thread_count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for finished in range(1, len(cubes) + 1):
+        result = results.get()
+        if isinstance(result, Exception):
+            raise result
+        i, solution, simulations, solve_time = result
+        yield SolveResult(i, solution, simulations, solve_time, finished / (time.time() - start_time))
+
+    for thread in threads:
+        thread.join()
@@ -16,6 +16,9 @@ from datetime import datetime
 import git # for keeping track of git versions
 
 from mcts_nn_cube import State, MCTSAgent
+from transposition_table import TranspositionTable, SharedTranspositionTable
+from endgame_oracle import EndgameOracle
+from search_cache import SearchResultCache
 import models
 #from pympler import tracker
 #tr1 = tracker.SummaryTracker()
@@ -35,6 +38,54 @@ def create_directory(dir_path):
     except FileExistsError:
         pass
 
+def locked_tee(iterable, n=2):
+    """
+    The same as itertools.tee, but the returned iterators can be used from different threads.
+    """
+    import threading
+    lock = threading.Lock()
+
+    def locked(iterator):
+        while True:
+            with lock:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    return [locked(iterator) for iterator in itertools.tee(iterable, n)]
+
+def threaded_generator(generator):
+    """
+    Runs the generator in its own thread (so it doesn't wait for the consumer), 
+    and yields its items.  Exceptions in the thread are raised by the returned generator.
+    """
+    import threading, queue
+    items = queue.Queue()
+    done = object()
+
+    def run_thread():
+        try:
+            for item in generator:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(done)
+
+    thread = threading.Thread(target=run_thread)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+    thread.join()
+
 
 # memory management
 MY_PROCESS = psutil.Process(os.getpid())
@@ -62,30 +113,66 @@ class BatchGameAgent():
     """
     Handles the steps of the games, including batch games.
     """
-    def __init__(self, model, max_steps, max_depth, min_game_length, max_game_length, transposition_table, decay, exploration, dirichlet_const):
+    def __init__(self, model, max_steps, max_depth, min_game_length, max_game_length, transposition_table, decay, exploration, dirichlet_const, shared_transposition_table=None, max_pending_evaluations=1, early_stopping=False, mcts_solver=False, endgame_oracle=None, min_steps=None, detect_cycles=False, use_symmetry=False, root_search='puct', gumbel_considered_actions=8, search_result_cache=None, 
+                 search_result_fresh_fraction=0.25, depth_policy='fixed', depth_multiple=3, max_tree_nodes=None):
         self.game_agents = deque()
         self.model = model
         self.max_depth = max_depth
         self.max_steps = max_steps
+        self.min_steps = min_steps # if not None, the number of steps is adapted (see MCTSAgent.adaptive_steps)
         self.min_game_length = min_game_length
         self.max_game_length = max_game_length
         self.transposition_table = transposition_table
+        self.shared_transposition_table = shared_transposition_table # used by all games if not None
         self.exploration = exploration
         self.decay = decay
         self.dirichlet_const = dirichlet_const
+        self.max_pending_evaluations = max_pending_evaluations # > 1 to pipeline the network evaluations
+        self.early_stopping = early_stopping
+        self.mcts_solver = mcts_solver
+        self.endgame_oracle = endgame_oracle
+        self.detect_cycles = detect_cycles
+        self.use_symmetry = use_symmetry
+        self.root_search = root_search # 'puct' or 'gumbel'
+        self.gumbel_considered_actions = gumbel_considered_actions
+        self.search_result_cache = search_result_cache # a SearchResultCache (shared between batches) or None
+        self.search_result_fresh_fraction = search_result_fresh_fraction # of the steps run even after a warm start
+        self.depth_policy = depth_policy # 'fixed', 'scramble' or 'value' (see MCTSAgent)
+        self.depth_multiple = depth_multiple
+        self.max_tree_nodes = max_tree_nodes # per game
 
     def is_empty(self):
         return not bool(self.game_agents)
 
     def append_states(self, state_info_iter):
         for game_id, state, distance, distance_level in state_info_iter:
+            if self.shared_transposition_table is not None:
+                transposition_table = self.shared_transposition_table
+            elif self.transposition_table is not None:
+                transposition_table = self.transposition_table.overlay()
+            else:
+                transposition_table = None
+
             mcts = MCTSAgent(self.model.function, 
                              state, 
                              max_depth = self.max_depth, 
-                             transposition_table = self.transposition_table.copy() if self.transposition_table is not None else None,
+                             transposition_table = transposition_table,
                              c_puct = self.exploration,
                              gamma = self.decay,
-                             dirichlet_const = self.dirichlet_const)
+                             dirichlet_const = self.dirichlet_const,
+                             model_policy_value_async = self.model.function_async if self.max_pending_evaluations > 1 else None,
+                             max_pending_evaluations = self.max_pending_evaluations,
+                             early_stopping = self.early_stopping,
+                             mcts_solver = self.mcts_solver,
+                             endgame_oracle = self.endgame_oracle,
+                             detect_cycles = self.detect_cycles,
+                             use_symmetry = self.use_symmetry,
+                             root_search = self.root_search,
+                             gumbel_considered_actions = self.gumbel_considered_actions,
+                             depth_policy = self.depth_policy,
+                             depth_multiple = self.depth_multiple,
+                             scramble_distance = distance,
+                             max_tree_nodes = self.max_tree_nodes)
             
             game_agent = GameAgent(game_id)
             game_agent.mcts = mcts
@@ -94,19 +181,40 @@ class BatchGameAgent():
 
             self.game_agents.append(game_agent)
 
+    def search_steps(self, mcts):
+        if self.min_steps is None:
+            return self.max_steps
+        return mcts.adaptive_steps(self.min_steps, self.max_steps)
+
+    def run_search(self, mcts):
+        """ 
+        Search from the root, warm-started from the cached search at the same state if any.
+        At least search_result_fresh_fraction of the steps are always run.
+        """
+        steps = self.search_steps(mcts)
+        # with the shared transposition table, the root node is also used by the other games
+        # (so it can't be overwritten by the warm start)
+        if self.search_result_cache is None or self.shared_transposition_table is not None or mcts.is_terminal():
+            mcts.search(steps=steps)
+            return
+
+        key = self.search_result_cache.key(mcts, self.model)
+        cached_result = self.search_result_cache.get(key)
+        if cached_result is not None:
+            fresh_steps = int(np.ceil(self.search_result_fresh_fraction * steps))
+            steps = max(fresh_steps, steps - mcts.warm_start(cached_result))
+        mcts.search(steps=steps)
+        self.search_result_cache.put(key, mcts.search_result())
+
     def run_game_agent_one_step(self, game_agent):
         mcts = game_agent.mcts
-        mcts.search(steps=self.max_steps)
-
-        # reduce the max batch size to prevent the worker from blocking
-        self.model.set_max_batch_size(self.model.get_max_batch_size() - 1)
+        self.run_search(mcts)
 
     def process_completed_step(self, game_agent):
         mcts = game_agent.mcts
             
         # find next state
-        probs = mcts.action_probabilities(inv_temp = 10)
-        action = np.argmax(probs)
+        action = mcts.best_action() # (the most visited action, unless using the Gumbel root search)
         #action = np.random.choice(12, p=probs)
 
         shortest_path = game_agent.mcts.stats('shortest_path')
@@ -122,9 +230,14 @@ class BatchGameAgent():
         game_agent.self_play_stats['prior_dirichlet'].append(mcts.stats('prior_dirichlet'))
         game_agent.self_play_stats['visit_counts'].append(mcts.stats('visit_counts'))
         game_agent.self_play_stats['total_action_values'].append(mcts.stats('total_action_values'))
+        game_agent.self_play_stats['simulations_saved'].append(mcts.stats('simulations_saved'))
+        game_agent.self_play_stats['simulations_reused'].append(mcts.stats('simulations_reused'))
+        for k, v in mcts.stats('search').items():
+            game_agent.self_play_stats['search_' + k].append(v)
 
         # training data (also recorded in stats)
-        game_agent.data_states.append(mcts.initial_node.state.input_array_no_history())
+        # (the actual state, since the root node may hold a rotation of it)
+        game_agent.data_states.append(mcts.root_state.input_array_no_history())
         
         policy = mcts.action_probabilities(inv_temp = 10)
         game_agent.data_policies.append(policy)
@@ -168,7 +281,7 @@ class BatchGameAgent():
         for game_agent in self.game_agents:
 
             mcts = game_agent.mcts
-            mcts.search(steps=self.max_steps)
+            self.run_search(mcts)
             
             self.process_completed_step(game_agent)
 
@@ -229,6 +342,10 @@ class TrainingAgent():
         if self.multithreaded:
             self.checkpoint_model.multithreaded = True
             self.best_model.multithreaded = True
+            self.checkpoint_model.max_batch_wait = config.max_batch_wait
+            self.best_model.max_batch_wait = config.max_batch_wait
+            # one worker thread for both models (interleaving their batches during evaluation)
+            self.inference_service = models.InferenceService([self.checkpoint_model, self.best_model])
         
         # Model training parameters (fixed)
         self.learning_rate = config.learning_rate
@@ -237,13 +354,35 @@ class TrainingAgent():
         # MCTS parameters (fixed)
         self.max_depth = config.max_depth
         self.max_steps = config.max_steps
+        self.min_steps = config.min_steps if config.adaptive_steps else None
         self.use_prebuilt_transposition_table = config.use_prebuilt_transposition_table
         self.use_transposition_table = config.use_transposition_table
+        self.transposition_table_max_entries = config.transposition_table_max_entries
+        self.transposition_table_max_bytes = config.transposition_table_max_bytes
+        self.transposition_table_replacement = config.transposition_table_replacement
+        self.use_shared_transposition_table = config.use_shared_transposition_table and self.prev_state_history == 1
+        self.shared_transposition_table_stripes = config.shared_transposition_table_stripes
         self.decay = config.decay # gamma
         self.exploration = config.exploration # c_puct
         self.dirichlet_const = config.dirichlet_const # alpha (None if no Dirichlet noise)
+        self.max_pending_evaluations = config.max_pending_evaluations
+        self.early_stopping = config.early_stopping
+        self.mcts_solver = config.mcts_solver
+        self.detect_cycles = config.detect_cycles
+        self.use_symmetry = config.use_symmetry and self.prev_state_history == 1
+        self.root_search = config.root_search
+        self.gumbel_considered_actions = config.gumbel_considered_actions
+        # cached root searches, kept across generations (the key includes the model weights version)
+        self.search_result_cache = SearchResultCache(config.search_result_cache_size) if config.use_search_result_cache else None
+        self.search_result_fresh_fraction = config.search_result_cache_fresh_fraction
+        self.depth_policy = config.depth_policy
+        self.depth_multiple = config.depth_multiple
+        self.max_tree_nodes = config.max_tree_nodes
+        self.endgame_table_path = config.endgame_table_path
+        self.endgame_oracle = None # loaded later
 
         self.prebuilt_transposition_table = None # built later
+        self.shared_transposition_table_stats = Counter() # summed over the batches of the generation
 
 
         # Validation flags
@@ -333,10 +472,21 @@ class TrainingAgent():
         warnings.warn("load_transposition_table is not properly implemented", stacklevel=2)
 
         if self.use_transposition_table:
-            self.prebuilt_transposition_table = {}
+            # each game uses a copy-on-write overlay of this table
+            self.prebuilt_transposition_table = TranspositionTable(max_entries=self.transposition_table_max_entries,
+                                                                   max_bytes=self.transposition_table_max_bytes,
+                                                                   replacement=self.transposition_table_replacement)
         else:
             self.prebuilt_transposition_table = None
 
+    def load_endgame_oracle(self):
+        if self.endgame_table_path is None:
+            self.endgame_oracle = None
+            return
+
+        self.endgame_oracle = EndgameOracle.load(self.endgame_table_path)
+        print("endgame table loaded: {} states up to distance {}".format(len(self.endgame_oracle), self.endgame_oracle.max_distance))
+
     def load_models(self):
         """ 
         Finds the checkpoint model and the best model in the given naming scheme 
@@ -475,6 +625,7 @@ class TrainingAgent():
         self.self_play_stats = defaultdict(list)
         self.game_stats = defaultdict(list)
         self.generation_stats = defaultdict(list)
+        self.shared_transposition_table_stats = Counter()
 
         # Training data (one item per game based on randomly chosen game state)
         self.training_data_states = []
@@ -501,6 +652,9 @@ class TrainingAgent():
         self.generation_stats['self_play_start_datetime_utc'].append(str(self.self_play_start))
         self.generation_stats['self_play_end_datetime_utc'].append(str(self.self_play_end))
         self.generation_stats['self_play_time_sec'].append((self.self_play_end - self.self_play_start).total_seconds())
+        if self.use_shared_transposition_table:
+            for k in ['lookups', 'hits', 'duplicate_insertions', 'lock_acquisitions', 'contentions']:
+                self.generation_stats['shared_transposition_table_' + k].append(self.shared_transposition_table_stats[k])
         
         generation_stats_df = pd.DataFrame(data=self.generation_stats)
         generation_stats_df.to_hdf(path, 'generation_stats', mode='a', format='fixed') #use mode='a' to avoid overwriting
@@ -676,6 +830,16 @@ class TrainingAgent():
         import heapq
         finished_games = [] # priority queue
 
+        if self.use_shared_transposition_table:
+            # the nodes depend on the model, so use a new table for each model
+            shared_transposition_table = SharedTranspositionTable(stripes=self.shared_transposition_table_stripes,
+                                                                  max_entries=self.transposition_table_max_entries,
+                                                                  max_bytes=self.transposition_table_max_bytes,
+                                                                  replacement=self.transposition_table_replacement,
+                                                                  base=self.prebuilt_transposition_table)
+        else:
+            shared_transposition_table = None
+
         batch_game_agent = BatchGameAgent(model=model,
                                           max_steps=self.max_steps, 
                                           max_depth=self.max_depth,
@@ -684,7 +848,22 @@ class TrainingAgent():
                                           transposition_table=self.prebuilt_transposition_table,
                                           decay=self.decay, 
                                           exploration=self.exploration,
-                                          dirichlet_const=self.dirichlet_const) 
+                                          dirichlet_const=self.dirichlet_const,
+                                          shared_transposition_table=shared_transposition_table,
+                                          max_pending_evaluations=self.max_pending_evaluations,
+                                          early_stopping=self.early_stopping,
+                                          mcts_solver=self.mcts_solver,
+                                          endgame_oracle=self.endgame_oracle,
+                                          min_steps=self.min_steps,
+                                          detect_cycles=self.detect_cycles,
+                                          use_symmetry=self.use_symmetry,
+                                          root_search=self.root_search,
+                                          gumbel_considered_actions=self.gumbel_considered_actions,
+                                          search_result_cache=self.search_result_cache,
+                                          search_result_fresh_fraction=self.search_result_fresh_fraction,
+                                          depth_policy=self.depth_policy,
+                                          depth_multiple=self.depth_multiple,
+                                          max_tree_nodes=self.max_tree_nodes) 
 
         # scale batch size up to make for better beginning determination of distance level
         # use batch size of 1 for first 16 games
@@ -738,6 +917,19 @@ class TrainingAgent():
             replacement_batch = itertools.islice(state_generator, available_slots)
             batch_game_agent.append_states(replacement_batch)
 
+        if shared_transposition_table is not None:
+            table_stats = shared_transposition_table.stats()
+            self.shared_transposition_table_stats.update({k: v for k, v in table_stats.items() if not k.endswith('_rate')})
+            print("(DB) shared transposition table: {entries} entries, hit rate: {hit_rate:.3f}, contention rate: {contention_rate:.4f}".format(**table_stats))
+
+        if self.search_result_cache is not None:
+            print("(DB) search result cache: {entries} entries, hit rate: {hit_rate:.3f}".format(**self.search_result_cache.stats()))
+
+        if model.multithreaded:
+            print("(DB) model batches: {batches}, mean size: {mean_batch_size:.1f}, full: {full_batch_rate:.3f}, "
+                  "mean queue latency: {mean_queue_latency:.0f}us, max: {max_queue_latency:.0f}us".format(**model.batch_stats()))
+            model.reset_batch_stats()
+
     def generate_data_self_play(self):
         # don't reset self_play since using the evaluation results to also get data
         #self.reset_self_play()
@@ -761,15 +953,33 @@ class TrainingAgent():
     def evaluate_and_choose_best_model(self):
         self.reset_self_play()
 
-        state_generator1, state_generator2 = itertools.tee(self.state_generator(self.games_per_evaluation, evaluation=True))
+        state_generator = self.state_generator(self.games_per_evaluation, evaluation=True)
+        if self.multithreaded:
+            state_generator1, state_generator2 = locked_tee(state_generator)
+        else:
+            state_generator1, state_generator2 = itertools.tee(state_generator)
 
         best_model_wins = 0
         checkpoint_model_wins = 0
         ties = 0
 
-        for game_results1, game_results2 \
-            in zip(self.game_generator(self.best_model, state_generator1, max_batch_size=self.batch_size, return_in_order=True), 
-                   self.game_generator(self.checkpoint_model, state_generator2, max_batch_size=self.batch_size, return_in_order=True)):
+        def update_level(games, checkpoint):
+            # update the win rates and level of the model as each game is yielded, before its 
+            # game_generator fills up its batch (which could otherwise run ahead of this loop)
+            for game_results in games:
+                self.update_win_and_level(game_results.distance, game_results.win, checkpoint=checkpoint)
+                yield game_results
+
+        best_model_games = self.game_generator(self.best_model, state_generator1, max_batch_size=self.batch_size, return_in_order=True)
+        checkpoint_model_games = self.game_generator(self.checkpoint_model, state_generator2, max_batch_size=self.batch_size, return_in_order=True)
+        best_model_games = update_level(best_model_games, checkpoint=False)
+        checkpoint_model_games = update_level(checkpoint_model_games, checkpoint=True)
+        if self.multithreaded:
+            # play the games of both models at the same time (the inference service interleaves their batches)
+            best_model_games = threaded_generator(best_model_games)
+            checkpoint_model_games = threaded_generator(checkpoint_model_games)
+
+        for game_results1, game_results2 in zip(best_model_games, checkpoint_model_games):
 
             if game_results1.win > game_results2.win:
                 best_model_wins += 1
@@ -790,10 +1000,6 @@ class TrainingAgent():
             self.training_data_policies += game_results.data_policies
             self.training_data_values += game_results.data_values
 
-            # update win rates and level
-            self.update_win_and_level(game_results1.distance, game_results1.win)
-            self.update_win_and_level(game_results2.distance, game_results2.win, checkpoint=True)
-
             # Print details
             self.print_eval_game_stats(game_results1, game_results2, [best_model_wins, checkpoint_model_wins, ties])
 
@@ -817,6 +1023,9 @@ def main(config):
     print("\nLoad pre-built transposition table...")
     agent.load_transposition_table()
 
+    print("\nLoad endgame table (if any)...")
+    agent.load_endgame_oracle()
+
     print("\nLoad models (if any)...")
     agent.load_models()
     
@@ -0,0 +1,286 @@
+"""
+A bounded transposition table for the MCTS.
+
+It behaves like the plain dictionary the MCTS used before (keyed by the packed
+bytes from State.key()), but it can be given a budget (in entries and/or bytes)
+and a replacement policy for when the budget is exceeded:
+
+- 'clock': the second-chance (clock) approximation of LRU.  Each entry has a
+  reference bit which is set on every hit.  When evicting, the oldest entry is
+  removed unless its bit is set, in which case the bit is cleared and the entry
+  is moved to the back of the queue.
+- 'depth': depth-preferred replacement.  The entries with the least search
+  effort below them (the node's total visit count, which plays the role of the
+  search depth in alpha-beta tables) are removed first.
+
+The budget only bounds the index.  An evicted node stays in the tree (through
+its parent's children) for as long as its parent does, so the memory of the
+search tree itself is not bounded by it (see max_tree_nodes in MCTSAgent).  If an evicted state is reached again by
+another path, it gets a second node (see TranspositionTable.is_bounded).
+
+A table can also be used as a shared read-only base for copy-on-write overlays.
+This makes starting a new game O(1) instead of copying the prebuilt table.
+
+SharedTranspositionTable is a thread-safe (lock striped) version which can be
+shared by all the concurrent games of a batch.
+"""
+from collections import OrderedDict
+import threading
+
+# estimate of the memory (in bytes) freed by evicting an entry, not counting the
+# key's bytes: the OrderedDict entry, the [node, reference bit] list and the key
+# object's header (measured on 64-bit CPython).  The node itself isn't counted,
+# since it is still referenced by its parent, so the max_bytes budget only bounds
+# the index (the tree is bounded by max_tree_nodes instead).
+ENTRY_OVERHEAD = 210
+
+# when the budget is exceeded with depth-preferred replacement, evict down to
+# this fraction of the budget at once (so the sorting cost is amortized)
+DEPTH_EVICTION_RATIO = 7/8
+
+class TranspositionTable():
+    """
+    A dictionary-like table from state keys to MCTS nodes, with an optional
+    budget, a replacement policy, and an optional read-only base table.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, replacement='clock', base=None, entry_overhead=ENTRY_OVERHEAD):
+        assert replacement in ('clock', 'depth'), "replacement must be 'clock' or 'depth'"
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.replacement = replacement
+        self.entry_overhead = entry_overhead
+        self._base = base
+        self._read_only = False
+
+        self._entries = OrderedDict() # key -> [value, reference bit]
+        self._bytes = 0
+
+        # stats
+        self.evictions = 0
+
+    def is_bounded(self):
+        """ Whether entries can be evicted (so a state may end up with more than one node). """
+        return self.max_entries is not None or self.max_bytes is not None
+
+    def __len__(self):
+        """ Number of entries stored locally (not counting the base). """
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (self._base is not None and key in self._base)
+
+    def __getitem__(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1] = True # reference bit
+            return entry[0]
+
+        if self._base is not None:
+            return self._base[key]
+
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        assert not self._read_only, "the table is read-only (it is the base of an overlay)"
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[0] = value
+            entry[1] = True
+            return
+
+        self._entries[key] = [value, False]
+        self._bytes += len(key) + self.entry_overhead
+
+        if self._over_budget():
+            self._evict()
+
+    def setdefault(self, key, value):
+        """ Stores the value unless the key is already present.  Returns the stored value. """
+        stored = self.get(key)
+        if stored is not None:
+            return stored
+        self[key] = value
+        return value
+
+    def nbytes(self):
+        """ Estimated memory used by the local entries. """
+        return self._bytes
+
+    def _over_budget(self):
+        return (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+               (self.max_bytes is not None and self._bytes > self.max_bytes)
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._bytes -= len(key) + self.entry_overhead
+        self.evictions += 1
+
+    def _evict(self):
+        if self.replacement == 'clock':
+            while self._over_budget():
+                key, entry = next(iter(self._entries.items()))
+                if entry[1]:
+                    # second chance
+                    entry[1] = False
+                    self._entries.move_to_end(key, last=True)
+                else:
+                    self._remove(key)
+        else:
+            # depth-preferred: remove the least searched nodes first (oldest first among ties)
+            target_entries = None if self.max_entries is None else int(self.max_entries * DEPTH_EVICTION_RATIO)
+            target_bytes = None if self.max_bytes is None else int(self.max_bytes * DEPTH_EVICTION_RATIO)
+
+            by_depth = sorted(self._entries.items(), key=lambda item: _search_depth(item[1][0]))
+            for key, _ in by_depth:
+                if (target_entries is None or len(self._entries) <= target_entries) and \
+                   (target_bytes is None or self._bytes <= target_bytes):
+                    break
+                self._remove(key)
+
+    def freeze(self):
+        """ Mark this table as read-only.  (Done automatically when used as a base.) """
+        self._read_only = True
+
+    def overlay(self):
+        """
+        Returns a new empty table (with the same budget and replacement policy) which
+        reads through to this table, but stores all new entries locally.  This table
+        becomes read-only.  This is O(1).
+        """
+        self.freeze()
+        return TranspositionTable(max_entries=self.max_entries,
+                                  max_bytes=self.max_bytes,
+                                  replacement=self.replacement,
+                                  base=self,
+                                  entry_overhead=self.entry_overhead)
+
+    def copy(self):
+        """ A (shallow) copy of the local entries.  The base, if any, is shared. """
+        table = TranspositionTable(max_entries=self.max_entries,
+                                   max_bytes=self.max_bytes,
+                                   replacement=self.replacement,
+                                   base=self._base,
+                                   entry_overhead=self.entry_overhead)
+        table._entries = OrderedDict((key, list(entry)) for key, entry in self._entries.items())
+        table._bytes = self._bytes
+        return table
+
+def _search_depth(node):
+    # terminal nodes don't have visit counts (and are cheap to recreate)
+    return getattr(node, 'total_visit_counts', 0)
+
+class SharedTranspositionTable():
+    """
+    A thread-safe transposition table shared by all the games in a batch, so that
+    games reuse the nodes (statistics and NN evaluations) of identical states.
+
+    It is split into stripes by the hash of the key.  Each stripe is a
+    TranspositionTable with its own lock, so threads rarely wait on each other.
+    Hits and lock contention are counted for reporting.
+    """
+    def __init__(self, stripes=16, max_entries=None, max_bytes=None, replacement='clock', base=None):
+        self._stripes = [TranspositionTable(max_entries=None if max_entries is None else max(1, max_entries // stripes),
+                                            max_bytes=None if max_bytes is None else max(1, max_bytes // stripes),
+                                            replacement=replacement,
+                                            base=base)
+                         for _ in range(stripes)]
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        if base is not None:
+            base.freeze()
+
+        # stats (one counter per stripe, only updated while holding that stripe's lock)
+        self._lookups = [0] * stripes
+        self._hits = [0] * stripes
+        self._insertions = [0] * stripes
+        self._duplicates = [0] * stripes
+        self._acquisitions = [0] * stripes
+        self._contentions = [0] * stripes
+
+    def _acquire(self, i):
+        lock = self._locks[i]
+        if not lock.acquire(blocking=False):
+            lock.acquire()
+            self._contentions[i] += 1
+        self._acquisitions[i] += 1
+        return lock
+
+    def is_bounded(self):
+        return self._stripes[0].is_bounded()
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self._stripes)
+
+    def __contains__(self, key):
+        i = hash(key) % len(self._stripes)
+        lock = self._acquire(i)
+        try:
+            return key in self._stripes[i]
+        finally:
+            lock.release()
+
+    def get(self, key, default=None):
+        i = hash(key) % len(self._stripes)
+        lock = self._acquire(i)
+        try:
+            self._lookups[i] += 1
+            value = self._stripes[i].get(key)
+            if value is None:
+                return default
+            self._hits[i] += 1
+            return value
+        finally:
+            lock.release()
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        i = hash(key) % len(self._stripes)
+        lock = self._acquire(i)
+        try:
+            self._insertions[i] += 1
+            self._stripes[i][key] = value
+        finally:
+            lock.release()
+
+    def setdefault(self, key, value):
+        """
+        Inserts the value unless another thread already stored this key.
+        Returns the stored value.
+        """
+        i = hash(key) % len(self._stripes)
+        lock = self._acquire(i)
+        try:
+            stored = self._stripes[i].setdefault(key, value)
+            if stored is value:
+                self._insertions[i] += 1
+            else:
+                self._duplicates[i] += 1 # the other thread's node is used, our evaluation is wasted
+            return stored
+        finally:
+            lock.release()
+
+    def stats(self):
+        """ Hit rate and lock contention, summed over the stripes. """
+        lookups = sum(self._lookups)
+        acquisitions = sum(self._acquisitions)
+        return {'entries': len(self),
+                'lookups': lookups,
+                'hits': sum(self._hits),
+                'hit_rate': sum(self._hits) / lookups if lookups else 0.,
+                'insertions': sum(self._insertions),
+                'duplicate_insertions': sum(self._duplicates),
+                'lock_acquisitions': acquisitions,
+                'contentions': sum(self._contentions),
+                'contention_rate': sum(self._contentions) / acquisitions if acquisitions else 0.}
@@ -0,0 +1,180 @@
+"""
+Save and load MCTS search trees in a compact columnar format.
+
+Pickling the MCTSNode objects is slow and large.  Instead, a snapshot is a
+directory with one .npy file per column (one row per node, with the children
+stored as node indices and the states as their packed keys) and a small json
+file for the agent's settings.  The columns are reloaded memory-mapped 
+(copy-on-write), so loading is fast, the nodes' statistics are views into the 
+mapped arrays, and the search can continue without changing the files.  The
+network is not called when loading.
+
+    save_tree(mcts, 'tree_dir')
+    mcts = load_tree('tree_dir', model.function)
+"""
+import json
+import numpy as np
+import os
+from mcts_nn_cube import MCTSAgent, MCTSNode, State, action_count
+
+SNAPSHOT_VERSION = 2 # 2 added distance_bound
+
+def _columns(mcts):
+    """ Number the nodes reachable from the root (breadth first) and build the columns. """
+    index = {id(mcts.initial_node): 0}
+    nodes = [mcts.initial_node]
+    i = 0
+    while i < len(nodes):
+        node = nodes[i]
+        i += 1
+        if node.terminal:
+            continue
+        for child_node in node.children:
+            if child_node is not None and id(child_node) not in index:
+                index[id(child_node)] = len(nodes)
+                nodes.append(child_node)
+
+    size = len(nodes)
+    history = mcts.initial_node.state.history_length()
+    columns = {'keys': np.zeros((size, history, 27), dtype=np.uint8),
+               'terminal': np.zeros(size, dtype=bool),
+               'is_leaf_node': np.zeros(size, dtype=bool),
+               'proven_distance': np.full(size, -1, dtype=np.int32),
+               'distance_bound': np.zeros(size, dtype=np.int32),
+               'node_value': np.zeros(size, dtype=np.float32),
+               'prior_probabilities': np.zeros((size, action_count), dtype=np.float32),
+               'total_visit_counts': np.zeros(size, dtype=np.int64),
+               'visit_counts': np.zeros((size, action_count), dtype=np.int32),
+               'total_action_values': np.zeros((size, action_count)),
+               'mean_action_values': np.zeros((size, action_count)),
+               'children': np.full((size, action_count), -1, dtype=np.int32)}
+
+    for i, node in enumerate(nodes):
+        columns['keys'][i] = np.frombuffer(node.state.key(), dtype=np.uint8).reshape((history, 27))
+        columns['terminal'][i] = node.terminal
+        if node.proven_distance is not None:
+            columns['proven_distance'][i] = node.proven_distance
+        columns['distance_bound'][i] = node.distance_bound
+        if node.terminal:
+            continue
+
+        node.wait_for_evaluation()
+        columns['is_leaf_node'][i] = node.is_leaf_node
+        columns['node_value'][i] = node.node_value
+        columns['prior_probabilities'][i] = node.prior_probabilities
+        columns['total_visit_counts'][i] = node.total_visit_counts
+        columns['visit_counts'][i] = node.visit_counts
+        columns['total_action_values'][i] = node.total_action_values
+        columns['mean_action_values'][i] = node.mean_action_values
+        for action, child_node in enumerate(node.children):
+            if child_node is not None:
+                columns['children'][i, action] = index[id(child_node)]
+
+    return columns
+
+def save_tree(mcts, directory):
+    """ Save the tree below the root of the MCTSAgent (and the agent's settings) to the directory. """
+    os.makedirs(directory, exist_ok=True)
+
+    for name, column in _columns(mcts).items():
+        np.save(os.path.join(directory, name + '.npy'), column)
+
+    np.save(os.path.join(directory, 'root_state.npy'), mcts.root_state._frames)
+    if mcts.root_prior_probabilities is not None:
+        np.save(os.path.join(directory, 'root_prior_probabilities.npy'), mcts.root_prior_probabilities)
+
+    settings = {'version': SNAPSHOT_VERSION,
+                'max_depth': mcts.max_depth,
+                'c_puct': mcts.c_puct,
+                'gamma': mcts.gamma,
+                'dirichlet_const': mcts.dirichlet_const,
+                'use_symmetry': mcts.use_symmetry,
+                'root_search': mcts.root_search,
+                'total_steps': mcts.total_steps,
+                'shortest_path': int(mcts.shortest_path),
+                'shortest_path_action': None if mcts.shortest_path_action is None else int(mcts.shortest_path_action)}
+    with open(os.path.join(directory, 'settings.json'), 'w') as f:
+        json.dump(settings, f, indent=2)
+
+def _unpack_keys(keys):
+    """ The (size, history, 54) color frames from the packed keys (two colors per byte). """
+    frames = np.empty(keys.shape[:-1] + (54, ), dtype=np.uint8)
+    frames[..., ::2] = keys >> 4
+    frames[..., 1::2] = keys & 15
+    return frames
+
+def load_tree(directory, model_policy_value, transposition_table=None, mmap=True, **agent_kwargs):
+    """
+    Load a tree saved with save_tree as an MCTSAgent (the network is not called).
+    The saved settings (max_depth, c_puct, etc.) are used unless given in agent_kwargs.
+    If a transposition table (e.g. {}) is given, all the loaded nodes are added to it.
+    If mmap is True, the columns are memory-mapped copy-on-write (changes aren't saved to the files).
+    """
+    with open(os.path.join(directory, 'settings.json')) as f:
+        settings = json.load(f)
+    assert settings['version'] in (1, SNAPSHOT_VERSION), "unknown snapshot version {}".format(settings['version'])
+
+    def load(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode='c' if mmap else None)
+
+    keys = load('keys')
+    frames = _unpack_keys(keys)
+    terminal = load('terminal')
+    is_leaf_node = load('is_leaf_node')
+    proven_distance = load('proven_distance')
+    if settings['version'] >= 2:
+        distance_bound = load('distance_bound')
+    else:
+        distance_bound = np.where(terminal, 0, 1) # the trivial bounds
+    node_value = load('node_value')
+    prior_probabilities = load('prior_probabilities')
+    total_visit_counts = load('total_visit_counts')
+    visit_counts = load('visit_counts')
+    total_action_values = load('total_action_values')
+    mean_action_values = load('mean_action_values')
+    children = load('children')
+    c_puct = agent_kwargs.get('c_puct', settings['c_puct'])
+
+    # build the nodes without calling MCTSNode.__init__ (which evaluates the state)
+    nodes = []
+    for i in range(len(keys)):
+        node = MCTSNode.__new__(MCTSNode)
+        node.state = State(_frames=frames[i])
+        node.terminal = bool(terminal[i])
+        node.proven_distance = None if proven_distance[i] < 0 else int(proven_distance[i])
+        node.distance_bound = int(distance_bound[i])
+        if not node.terminal:
+            node.c_puct = c_puct
+            node.is_leaf_node = bool(is_leaf_node[i])
+            node.pending_evaluation = None
+            node.node_value = node_value[i]
+            node.prior_probabilities = prior_probabilities[i]
+            node.total_visit_counts = int(total_visit_counts[i])
+            node.visit_counts = visit_counts[i]
+            node.total_action_values = total_action_values[i]
+            node.mean_action_values = mean_action_values[i]
+        nodes.append(node)
+
+    for node, node_children in zip(nodes, children):
+        if not node.terminal:
+            node.children = [None if j < 0 else nodes[j] for j in node_children]
+
+    if transposition_table is not None:
+        for node, key in zip(nodes, keys):
+            transposition_table[key.tobytes()] = node
+
+    for name in ('max_depth', 'c_puct', 'gamma', 'dirichlet_const', 'use_symmetry', 'root_search'):
+        agent_kwargs.setdefault(name, settings[name])
+    root_state = State(_frames=np.load(os.path.join(directory, 'root_state.npy')))
+    mcts = MCTSAgent(model_policy_value, root_state, transposition_table=transposition_table, 
+                     initial_node=nodes[0], **agent_kwargs)
+
+    mcts.nodes_created = len(nodes)
+    mcts.total_steps = settings['total_steps']
+    mcts.shortest_path = settings['shortest_path']
+    mcts.shortest_path_action = settings['shortest_path_action']
+    root_prior_path = os.path.join(directory, 'root_prior_probabilities.npy')
+    if os.path.exists(root_prior_path):
+        mcts.root_prior_probabilities = np.load(root_prior_path)
+
+    return mcts